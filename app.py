@@ -12,11 +12,13 @@ NEW IN v32:
 """
 
 import streamlit as st
+import numpy as np
 import google.generativeai as genai
 import json
+import html
 import re
 import sqlite3
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter
+from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter, ImageOps
 import requests
 from datetime import datetime, timedelta
 import uuid
@@ -28,6 +30,14 @@ import hashlib
 import os
 import random
 import math
+import threading
+import queue
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+try: import cv2
+except ImportError: cv2 = None
 
 st.set_page_config(page_title="HonestWorld", page_icon="🌍", layout="centered", initial_sidebar_state="collapsed")
 
@@ -39,6 +49,7 @@ def get_secret(key, default=""):
     except: return os.environ.get(key, default)
 
 GEMINI_API_KEY = get_secret("GEMINI_API_KEY", "")
+GEMINI_MODEL = "gemini-2.0-flash-exp"
 SUPABASE_URL = get_secret("SUPABASE_URL", "")
 SUPABASE_KEY = get_secret("SUPABASE_KEY", "")
 ADMIN_HASH = hashlib.sha256("honestworld2024".encode()).hexdigest()
@@ -48,22 +59,81 @@ ADMIN_HASH = hashlib.sha256("honestworld2024".encode()).hexdigest()
 # ═══════════════════════════════════════════════════════════════════════════════
 BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
 
-def encode_geohash(lat, lon, precision=6):
-    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
-    geohash, bits, bit, ch, even = [], [16, 8, 4, 2, 1], 0, 0, True
-    while len(geohash) < precision:
-        if even:
-            mid = (lon_range[0] + lon_range[1]) / 2
-            if lon > mid: ch |= bits[bit]; lon_range[0] = mid
-            else: lon_range[1] = mid
+_BASE32_BYTES = np.frombuffer(BASE32.encode(), dtype=np.uint8)
+_BASE32_LOOKUP = np.full(256, -1, dtype=np.int64)
+_BASE32_LOOKUP[_BASE32_BYTES] = np.arange(32)
+GEOHASH_MAX_PRECISION = 12  # 60 bits, fits an int64
+
+def encode_geohash_array(lats, lons, precision=6):
+    """Geohash every (lat, lon) pair at once; returns an array of str.
+    
+    Bisects all points in lockstep, so boundary points land in the same cell as the
+    scalar algorithm (a value equal to the midpoint goes to the lower half). Cell edges
+    are exact binary fractions of the range, so tracking only the lower edge is exact.
+    """
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    precision = min(precision, GEOHASH_MAX_PRECISION)
+    lat_lo, lon_lo = np.full(lats.shape, -90.0), np.full(lons.shape, -180.0)
+    lat_half, lon_half = 90.0, 180.0
+    code = np.zeros(lats.shape, dtype=np.int64)
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            up = lons > lon_lo + lon_half
+            lon_lo += up * lon_half
+            lon_half /= 2
         else:
-            mid = (lat_range[0] + lat_range[1]) / 2
-            if lat > mid: ch |= bits[bit]; lat_range[0] = mid
-            else: lat_range[1] = mid
-        even = not even
-        if bit < 4: bit += 1
-        else: geohash.append(BASE32[ch]); bit, ch = 0, 0
-    return ''.join(geohash)
+            up = lats > lat_lo + lat_half
+            lat_lo += up * lat_half
+            lat_half /= 2
+        code = (code << 1) | up
+    shifts = 5 * np.arange(precision - 1, -1, -1, dtype=np.int64)
+    chars = _BASE32_BYTES[(code[..., None] >> shifts) & 31]
+    return np.ascontiguousarray(chars).view(f'S{precision}')[..., 0].astype(str)
+
+def geohash_bbox_array(hashes):
+    """(lat_min, lat_max, lon_min, lon_max) arrays for an array of geohashes of any lengths."""
+    raw = np.asarray(hashes, dtype=bytes)
+    width = max(raw.dtype.itemsize, 1)
+    chars = np.frombuffer(raw.astype(f'S{width}').tobytes(), dtype=np.uint8).reshape(raw.shape + (width,))
+    values = np.maximum(_BASE32_LOOKUP[chars], 0)  # padding past a short hash decodes as 0 bits
+    lat_lo, lon_lo = np.full(raw.shape, -90.0), np.full(raw.shape, -180.0)
+    lat_half, lon_half = 90.0, 180.0
+    for i in range(5 * width):
+        up = (values[..., i // 5] >> (4 - i % 5)) & 1
+        if i % 2 == 0:
+            lon_lo += up * lon_half
+            lon_half /= 2
+        else:
+            lat_lo += up * lat_half
+            lat_half /= 2
+    bits = 5 * (_BASE32_LOOKUP[chars] >= 0).sum(axis=-1)
+    lat_size, lon_size = np.ldexp(180.0, -(bits // 2)), np.ldexp(360.0, -((bits + 1) // 2))
+    return lat_lo, lat_lo + lat_size, lon_lo, lon_lo + lon_size
+
+def decode_geohash_array(hashes):
+    """Cell centres and half-sizes as (lat, lon, lat_err, lon_err) arrays."""
+    lat_lo, lat_hi, lon_lo, lon_hi = geohash_bbox_array(hashes)
+    return (lat_lo + lat_hi) / 2, (lon_lo + lon_hi) / 2, (lat_hi - lat_lo) / 2, (lon_hi - lon_lo) / 2
+
+def encode_geohash(lat, lon, precision=6):
+    return str(encode_geohash_array([lat], [lon], precision)[0])
+
+def decode_geohash(geohash):
+    lat, lon, _, _ = decode_geohash_array([geohash])
+    return float(lat[0]), float(lon[0])
+
+def geohash_bbox(geohash):
+    return tuple(float(v[0]) for v in geohash_bbox_array([geohash]))
+
+GEOHASH_DIRECTIONS = {'n': (1, 0), 'ne': (1, 1), 'e': (0, 1), 'se': (-1, 1), 's': (-1, 0), 'sw': (-1, -1), 'w': (0, -1), 'nw': (1, -1)}
+
+def geohash_neighbors(geohash):
+    """The 8 adjacent cells by direction; longitude wraps, cells past a pole are omitted."""
+    lat, lon, lat_err, lon_err = (float(v[0]) for v in decode_geohash_array([geohash]))
+    dirs = [(d, lat + 2 * lat_err * dy, (lon + 2 * lon_err * dx + 180) % 360 - 180) for d, (dy, dx) in GEOHASH_DIRECTIONS.items()]
+    dirs = [(d, la, lo) for d, la, lo in dirs if -90 < la < 90]
+    cells = encode_geohash_array([la for _, la, _ in dirs], [lo for _, _, lo in dirs], len(geohash))
+    return {d: str(cell) for (d, _, _), cell in zip(dirs, cells)}
 
 def add_privacy_jitter(lat, lon, meters=75):
     earth_radius = 6371000
@@ -439,6 +509,346 @@ def get_alternative(product_name, product_type, product_category, country_code):
     
     return country_alts['default']
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# HTTP CLIENT
+# ═══════════════════════════════════════════════════════════════════════════════
+# (connect, read) timeouts per upstream host
+HTTP_DEFAULT_TIMEOUT = (3.05, 10)
+HTTP_HOST_TIMEOUTS = {
+    'world.openfoodfacts.org': (3.05, 12),
+    'world.openbeautyfacts.org': (3.05, 12),
+    'openlibrary.org': (3.05, 12),
+    'api.upcitemdb.com': (3.05, 12),
+    'ipapi.co': (2, 5),
+    'ip-api.com': (2, 5),
+}
+HTTP_POOL_SIZE = 16
+HTTP_MAX_RETRIES = 2
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_BACKOFF_BASE = 0.25
+HTTP_BACKOFF_CAP = 4.0
+
+class HTTPClient:
+    """One keep-alive requests.Session per upstream host, shared by every session in the process."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, host):
+        with self.lock:
+            sess = self.sessions.get(host)
+            if sess is None:
+                sess = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+                sess.mount('https://', adapter)
+                sess.mount('http://', adapter)
+                sess.headers.update({'Accept-Encoding': 'gzip, deflate', 'User-Agent': f'HonestWorld/{VERSION}'})
+                self.sessions[host] = sess
+            return sess
+
+@st.cache_resource
+def get_http_client():
+    return HTTPClient()
+
+# Circuit breakers: a provider whose recent calls mostly fail (errors, 429/5xx or slower
+# than BREAKER_SLOW_CALL) is skipped for BREAKER_COOLDOWN, then probed with a single call.
+BREAKER_WINDOW = 120
+BREAKER_MIN_CALLS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_SLOW_CALL = 8.0
+BREAKER_COOLDOWN = 30
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.calls = deque()  # (timestamp, ok, latency) within BREAKER_WINDOW
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.totals = {'calls': 0, 'failures': 0, 'rejected': 0, 'trips': 0}
+
+    def available(self):
+        """True unless open and still cooling down (does not claim the half-open probe)."""
+        with self.lock:
+            return self.state != 'open' or time.time() - self.opened_at >= BREAKER_COOLDOWN
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.time() - self.opened_at < BREAKER_COOLDOWN:
+                    self.totals['rejected'] += 1
+                    return False
+                self.state, self.probing = 'half_open', False
+            if self.state == 'half_open':
+                if self.probing:
+                    self.totals['rejected'] += 1
+                    return False
+                self.probing = True
+            return True
+
+    def record(self, ok, latency):
+        now = time.time()
+        ok = ok and latency < BREAKER_SLOW_CALL
+        with self.lock:
+            was_open = self.state == 'open'
+            self.totals['calls'] += 1
+            if not ok: self.totals['failures'] += 1
+            self.calls.append((now, ok, latency))
+            while self.calls and self.calls[0][0] < now - BREAKER_WINDOW: self.calls.popleft()
+            if self.state == 'half_open':
+                self.probing = False
+                if ok:
+                    self.state = 'closed'
+                    self.calls.clear()
+                else:
+                    self._trip(now)
+            elif not ok and len(self.calls) >= BREAKER_MIN_CALLS and self._error_rate() >= BREAKER_ERROR_RATE:
+                self._trip(now)
+        # Log every upstream's health when one trips, outside the lock (provider_health takes it)
+        if self.state == 'open' and not was_open: print(f"Circuit {self.name} opened; upstream health: {provider_health()}")
+
+    def _trip(self, now):
+        self.state, self.opened_at = 'open', now
+        self.totals['trips'] += 1
+
+    def _error_rate(self):
+        return sum(1 for _, ok, _ in self.calls if not ok) / len(self.calls) if self.calls else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(lat for _, _, lat in self.calls)
+            return dict(self.totals, state=self.state, window_calls=len(self.calls), error_rate=round(self._error_rate(), 3),
+                        p50_latency=round(latencies[len(latencies) // 2], 3) if latencies else None,
+                        p95_latency=round(latencies[int(len(latencies) * 0.95)], 3) if latencies else None)
+
+class BreakerRegistry:
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.breakers: self.breakers[name] = CircuitBreaker(name)
+            return self.breakers[name]
+
+@st.cache_resource
+def get_breaker_registry():
+    return BreakerRegistry()
+
+def get_breaker(name):
+    return get_breaker_registry().get(name)
+
+def provider_health():
+    """Breaker state, rolling error rate and latency for every upstream seen so far."""
+    registry = get_breaker_registry()
+    with registry.lock:
+        breakers = list(registry.breakers.values())
+    return {b.name: b.snapshot() for b in breakers}
+
+def _retry_delay(attempt, response=None):
+    """Full-jitter exponential backoff; honours a short numeric Retry-After."""
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit(): return float(retry_after)
+    return random.uniform(0, min(HTTP_BACKOFF_CAP, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+def http_request(method, url, timeout=None, retries=None, breaker=None, **kwargs):
+    """Send a request through the pooled session for the URL's host.
+    
+    Connection failures and 429/5xx responses are retried with jittered backoff (GETs by
+    default; pass `retries` for idempotent writes). Read timeouts are not retried. After the
+    last attempt the final response is returned as-is, so callers keep checking status codes.
+    With `breaker`, the whole call is guarded by that circuit breaker and raises
+    CircuitOpenError without touching the network while it is open.
+    """
+    if breaker is None: return _http_request(method, url, timeout, retries, **kwargs)
+    cb = get_breaker(breaker)
+    if not cb.allow(): raise CircuitOpenError(f"{breaker} circuit open")
+    start = time.perf_counter()
+    try:
+        r = _http_request(method, url, timeout, retries, **kwargs)
+    except Exception:
+        cb.record(False, time.perf_counter() - start)
+        raise
+    cb.record(r.status_code not in HTTP_RETRY_STATUSES, time.perf_counter() - start)
+    return r
+
+def _http_request(method, url, timeout, retries, **kwargs):
+    host = urllib.parse.urlsplit(url).hostname or ''
+    session = get_http_client().session(host)
+    timeout = timeout or HTTP_HOST_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+    if retries is None: retries = HTTP_MAX_RETRIES if method == 'GET' else 0
+    for attempt in range(retries + 1):
+        try:
+            r = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.ConnectionError:
+            if attempt == retries: raise
+            time.sleep(_retry_delay(attempt))
+            continue
+        if r.status_code not in HTTP_RETRY_STATUSES or attempt == retries: return r
+        delay = _retry_delay(attempt, r)
+        if delay > HTTP_BACKOFF_CAP: return r
+        time.sleep(delay)
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+def http_post(url, **kwargs):
+    return http_request('POST', url, **kwargs)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# GEMINI CLIENTS
+# ═══════════════════════════════════════════════════════════════════════════════
+# genai.configure() discards the SDK's cached service clients, so it runs once per process and
+# every session shares one gRPC channel and one GenerativeModel per (model, generation config)
+GEMINI_ANALYSIS_CONFIG = {"temperature": 0.1, "max_output_tokens": 8192}
+
+@st.cache_resource
+def configure_gemini():
+    genai.configure(api_key=GEMINI_API_KEY)
+    return True
+
+@st.cache_resource
+def get_gemini_model(model_name=GEMINI_MODEL, generation_config=None):
+    configure_gemini()
+    return genai.GenerativeModel(model_name, generation_config=generation_config)
+
+# Photos are sent upright, downsized and recompressed: Gemini tiles images at 768 px, so a
+# 1536 px long edge keeps label text legible without paying for 12 MP of pixels
+GEMINI_IMAGE_MAX_EDGE = 1536
+GEMINI_IMAGE_MAX_BYTES = 400 * 1024
+GEMINI_IMAGE_FORMAT = 'JPEG'  # or 'WEBP'
+GEMINI_IMAGE_QUALITIES = (85, 75, 65, 50)
+GEMINI_IMAGE_MIME = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+def prepare_gemini_image(source, max_edge=GEMINI_IMAGE_MAX_EDGE, max_bytes=GEMINI_IMAGE_MAX_BYTES, fmt=GEMINI_IMAGE_FORMAT):
+    """Inline image part for generate_content: EXIF-upright, at most max_edge px, under max_bytes.
+    
+    Steps down GEMINI_IMAGE_QUALITIES, then the edge, until the encoding fits. Without this the
+    SDK uploads a PIL image from memory as a lossless WebP of the full frame.
+    """
+    if hasattr(source, 'seek'): source.seek(0)
+    img = source if isinstance(source, Image.Image) else Image.open(source)
+    w, h = img.size
+    img.draft('RGB', (max(1, max_edge * w // max(w, h)), max(1, max_edge * h // max(w, h))))  # JPEG decodes at a cheaper DCT scale
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, 'white')
+        img.paste(rgba, mask=rgba.getchannel('A'))
+    elif img.mode != 'RGB': img = img.convert('RGB')
+    edge = max_edge
+    while True:
+        frame = img.copy()
+        frame.thumbnail((edge, edge), Image.LANCZOS)
+        for quality in GEMINI_IMAGE_QUALITIES:
+            buf = BytesIO()
+            frame.save(buf, format=fmt, quality=quality)
+            if buf.tell() <= max_bytes or edge < 256: return {'mime_type': GEMINI_IMAGE_MIME[fmt], 'data': buf.getvalue()}
+        edge = edge * 3 // 4
+
+@st.cache_resource
+def warm_up_gemini():
+    """Build the shared models and open the channel in the background, once per process."""
+    if not GEMINI_API_KEY: return False
+    def run():
+        try:
+            get_gemini_model(GEMINI_MODEL)
+            get_gemini_model(GEMINI_MODEL, GEMINI_ANALYSIS_CONFIG).count_tokens("ping")  # free call, connects the channel
+        except Exception as e: print(f"Gemini warm-up error: {e}")
+    threading.Thread(target=run, name='hw-gemini-warmup', daemon=True).start()
+    return True
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# STREAMING JSON
+# ═══════════════════════════════════════════════════════════════════════════════
+# Analyses are streamed; each top-level field of the answer is handed out as soon as its
+# value is complete, so the UI can show the product and score before the model finishes.
+class JSONStreamParser:
+    """Incremental parser for the first JSON object in a streamed model answer.
+    
+    Prose or ``` fences before the object are skipped; a field whose value does not parse is
+    left out rather than failing the whole answer, and a truncated answer keeps what was complete."""
+    def __init__(self):
+        self.text, self.pos, self.start, self.end = "", 0, None, None
+        self.depth, self.in_str, self.esc = 0, False, False
+        self.key, self.key_start, self.value_start, self.colon = None, None, None, False
+        self.fields = {}
+    
+    def feed(self, chunk):
+        """Consume a chunk; returns the names of fields completed by it."""
+        self.text += chunk
+        done, text = [], self.text
+        while self.pos < len(text) and self.end is None:
+            i, ch = self.pos, text[self.pos]
+            self.pos += 1
+            if self.start is None:
+                if ch == '{': self.start, self.depth = i, 1
+            elif self.in_str:
+                if self.esc: self.esc = False
+                elif ch == '\\': self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+                    if self.depth > 1: continue
+                    if self.key_start is not None:
+                        try: self.key = json.loads(text[self.key_start:i + 1])
+                        except: self.key = ""
+                        self.key_start = None
+                    elif self.value_start is not None: self._emit(i + 1, done)
+            elif ch == '"':
+                self.in_str = True
+                if self.depth == 1:
+                    if self.key is None: self.key_start = i
+                    elif self.colon: self.value_start = i
+            elif ch in '{[':
+                if self.depth == 1 and self.colon: self.value_start = i
+                self.depth += 1
+            elif ch in '}]':
+                self.depth -= 1
+                if self.depth == 1 and self.value_start is not None: self._emit(i + 1, done)
+                elif self.depth == 0:
+                    if self.value_start is not None: self._emit(i, done)
+                    self.end = i + 1
+            elif self.depth == 1:
+                if ch == ',':
+                    if self.value_start is not None: self._emit(i, done)
+                    self.key, self.colon = None, False
+                elif ch == ':' and self.key is not None: self.colon = True
+                elif self.colon and self.value_start is None and not ch.isspace(): self.value_start = i
+        return done
+    
+    def _emit(self, end, done):
+        try:
+            self.fields[self.key] = json.loads(self.text[self.value_start:end])
+            done.append(self.key)
+        except: pass
+        self.key, self.value_start, self.colon = None, None, False
+    
+    def result(self):
+        """The whole object if it parses, else the fields completed so far (None if there are none)."""
+        if self.end is not None:
+            try: return json.loads(self.text[self.start:self.end])
+            except: pass
+        return dict(self.fields) or None
+
+def stream_json_response(model, contents, on_field=None):
+    """Generate with streaming, calling on_field(name, fields) as top-level fields complete.
+    
+    Returns (parsed object or None, whether the object was complete)."""
+    parser = JSONStreamParser()
+    for chunk in model.generate_content(contents, stream=True):
+        try: piece = chunk.text
+        except: continue  # chunks without text (safety/finish metadata)
+        for name in parser.feed(piece):
+            if on_field:
+                try: on_field(name, parser.fields)
+                except Exception as e: print(f"Stream callback error: {e}")
+    return parser.result(), parser.end is not None
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # LOCATION DETECTION
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -455,7 +865,7 @@ def detect_location_enhanced():
         {'url': 'https://ip-api.com/json/', 'extract': lambda d: (d.get('city'), d.get('country'), d.get('countryCode'), d.get('lat'), d.get('lon'), d.get('regionName'))},
     ]:
         try:
-            r = requests.get(service['url'], timeout=5)
+            r = http_get(service['url'])
             if r.ok:
                 d = r.json()
                 extracted = service['extract'](d)
@@ -659,6 +1069,148 @@ def get_cosmetic_highlights(ingredients, ingredients_flagged):
 def get_health_grade_color(grade):
     return {'A': '#22c55e', 'B': '#84cc16', 'C': '#f59e0b', 'D': '#f97316', 'E': '#ef4444'}.get(grade, '#6b7280')
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# PROCESS-WIDE CACHES & BACKGROUND WORKERS
+# ═══════════════════════════════════════════════════════════════════════════════
+class LRUCache:
+    """Thread-safe LRU with per-entry expiry and hit/miss counters, shared across sessions."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[1] <= time.time():
+                del self.data[key]
+                self.stats['expired'] += 1
+                item = None
+            if item is None:
+                self.stats['misses'] += 1
+                return None
+            self.data.move_to_end(key)
+            self.stats['hits'] += 1
+            return dict(item[0]) if isinstance(item[0], dict) else item[0]
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def pop(self, key):
+        with self.lock:
+            return self.data.pop(key, (None,))[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def incr(self, counter, n=1):
+        with self.lock:
+            self.stats[counter] = self.stats.get(counter, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.data), maxsize=self.maxsize)
+
+def _run_periodically(interval, fn, wake=None):
+    while True:
+        if wake is None: time.sleep(interval)
+        elif wake.wait(interval): wake.clear()
+        try: fn()
+        except Exception as e: print(f"Background task {fn.__name__} error: {e}")
+
+@st.cache_resource
+def start_background_worker(name, interval, _fn, _wake=None):
+    """Run _fn every `interval` seconds on a daemon thread, started once per process per name.
+    
+    Setting the optional `_wake` event runs it early.
+    """
+    t = threading.Thread(target=_run_periodically, args=(interval, _fn, _wake), name=f"hw-{name}", daemon=True)
+    t.start()
+    return t
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# DATABASE CONNECTION MANAGER
+# ═══════════════════════════════════════════════════════════════════════════════
+DB_POOL_SIZE = 8
+DB_PRAGMAS = [
+    ('journal_mode', 'WAL'),           # readers no longer block on the writer
+    ('synchronous', 'NORMAL'),         # with WAL, fsync at checkpoint instead of every commit
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -16000),            # ~16 MB page cache per connection
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+]
+
+class ConnectionPool:
+    """Process-wide pool of SQLite connections. A thread holds at most one checked-out
+    connection at a time, so nested helpers share it (and its open transaction)."""
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.local = threading.local()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256)
+        for name, value in DB_PRAGMAS:
+            conn.execute(f'PRAGMA {name}={value}')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        try: conn = self.idle.get_nowait()
+        except queue.Empty: conn = self._open()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            if conn.in_transaction: conn.rollback()
+            try: self.idle.put_nowait(conn)
+            except queue.Full: conn.close()
+
+@st.cache_resource
+def get_db_pool(path):
+    return ConnectionPool(path)
+
+def db_connection():
+    return get_db_pool(str(LOCAL_DB)).connection()
+
+@contextmanager
+def db_transaction():
+    """One unit of work (BEGIN IMMEDIATE ... COMMIT). Nested calls join the outer transaction."""
+    with db_connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+def db_query(sql, params=()):
+    with db_connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def db_query_one(sql, params=()):
+    with db_connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # DATABASE FUNCTIONS
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -670,10 +1222,13 @@ def get_product_hash(product_name, brand=""):
     normalized = normalize_product_name(f"{brand} {product_name}")
     return hashlib.md5(normalized.encode()).hexdigest()[:16]
 
-def init_db():
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS scans (id INTEGER PRIMARY KEY AUTOINCREMENT, scan_id TEXT UNIQUE, user_id TEXT, ts DATETIME DEFAULT CURRENT_TIMESTAMP, product TEXT, brand TEXT, product_hash TEXT, product_category TEXT, product_type TEXT, score INTEGER, verdict TEXT, ingredients TEXT, violations TEXT, bonuses TEXT, notifications TEXT, thumb BLOB, favorite INTEGER DEFAULT 0, deleted INTEGER DEFAULT 0, lat REAL, lon REAL, geohash TEXT, city TEXT, country TEXT, implied_promise TEXT, value_discrepancy INTEGER DEFAULT 0, health_grade TEXT)''')
+SCANS_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, scan_id TEXT UNIQUE, user_id TEXT, ts DATETIME DEFAULT CURRENT_TIMESTAMP, product TEXT, brand TEXT, product_hash TEXT, product_category TEXT, product_type TEXT, score INTEGER, verdict TEXT, ingredients TEXT, violations TEXT, bonuses TEXT, notifications TEXT, thumb BLOB, favorite INTEGER DEFAULT 0, deleted INTEGER DEFAULT 0, lat REAL, lon REAL, geohash TEXT, city TEXT, country TEXT, implied_promise TEXT, value_discrepancy INTEGER DEFAULT 0, health_grade TEXT)'''
+
+# Columns older releases bolted onto scans with ALTER TABLE (all of them as TEXT)
+SCANS_LATE_COLUMNS = {'lat': 'REAL', 'lon': 'REAL', 'geohash': 'TEXT', 'city': 'TEXT', 'country': 'TEXT', 'implied_promise': 'TEXT', 'value_discrepancy': 'INTEGER DEFAULT 0', 'health_grade': 'TEXT'}
+
+def _migrate_base_tables(c):
+    c.execute(SCANS_TABLE_SQL.format(table='scans'))
     c.execute('''CREATE TABLE IF NOT EXISTS verified_products (id INTEGER PRIMARY KEY AUTOINCREMENT, product_hash TEXT UNIQUE, product_name TEXT, brand TEXT, verified_score INTEGER, scan_count INTEGER DEFAULT 1, product_category TEXT, ingredients TEXT, violations TEXT, last_verified DATETIME DEFAULT CURRENT_TIMESTAMP)''')
     c.execute('''CREATE TABLE IF NOT EXISTS barcode_cache (barcode TEXT PRIMARY KEY, product_name TEXT, brand TEXT, ingredients TEXT, product_type TEXT, categories TEXT, nutrition TEXT, image_url TEXT, source TEXT, description TEXT, last_updated DATETIME DEFAULT CURRENT_TIMESTAMP)''')
     c.execute('CREATE TABLE IF NOT EXISTS allergies (a TEXT PRIMARY KEY)')
@@ -681,31 +1236,171 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY DEFAULT 1, scans INTEGER DEFAULT 0, flagged INTEGER DEFAULT 0, streak INTEGER DEFAULT 0, best_streak INTEGER DEFAULT 0, last_scan DATE)''')
     c.execute('INSERT OR IGNORE INTO stats (id) VALUES (1)')
     c.execute('''CREATE TABLE IF NOT EXISTS user_info (id INTEGER PRIMARY KEY DEFAULT 1, user_id TEXT, city TEXT, country TEXT, country_code TEXT, lat REAL, lon REAL)''')
-    c.execute('SELECT user_id FROM user_info WHERE id=1')
-    if not c.fetchone():
+    if not c.execute('SELECT user_id FROM user_info WHERE id=1').fetchone():
         c.execute('INSERT INTO user_info (id, user_id) VALUES (1, ?)', (str(uuid.uuid4()),))
-    
-    for col in ['lat', 'lon', 'geohash', 'city', 'country', 'implied_promise', 'value_discrepancy', 'health_grade']:
-        try: c.execute(f'ALTER TABLE scans ADD COLUMN {col} TEXT')
-        except: pass
-    
-    conn.commit()
-    conn.close()
 
+def _migrate_scan_column_types(c):
+    """Add late columns that are missing and rebuild scans if earlier ALTERs typed them as TEXT."""
+    declared = {r[1]: (r[2] or '').upper() for r in c.execute('PRAGMA table_info(scans)')}
+    for col, decl in SCANS_LATE_COLUMNS.items():
+        if col not in declared: c.execute(f'ALTER TABLE scans ADD COLUMN {col} {decl}')
+    mistyped = [col for col, decl in SCANS_LATE_COLUMNS.items() if col in declared and declared[col] != decl.split()[0]]
+    if not mistyped: return
+    cols = [r[1] for r in c.execute('PRAGMA table_info(scans)')]
+    select = ', '.join(f"CAST(NULLIF({col}, '') AS {SCANS_LATE_COLUMNS[col].split()[0]})" if col in mistyped else col for col in cols)
+    c.execute(SCANS_TABLE_SQL.format(table='scans_rebuild'))
+    c.execute(f'INSERT INTO scans_rebuild ({", ".join(cols)}) SELECT {select} FROM scans')
+    c.execute('DROP TABLE scans')
+    c.execute('ALTER TABLE scans_rebuild RENAME TO scans')
+
+def _migrate_hot_query_indexes(c):
+    # get_history: WHERE user_id=? AND deleted=0 ORDER BY ts DESC
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scans_history ON scans(user_id, deleted, ts DESC, scan_id, product, brand, score, verdict, favorite)')
+    # get_map_data: WHERE lat/lon NOT NULL ORDER BY ts DESC (partial + covering)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scans_map ON scans(ts DESC, lat, lon, geohash, score, verdict, city, country, product) WHERE lat IS NOT NULL AND lon IS NOT NULL')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scans_product_hash ON scans(product_hash)')
+
+def _migrate_thumbnail_store(c):
+    """Move inline JPEG thumbnails into a content-addressed side table."""
+    c.execute('CREATE TABLE IF NOT EXISTS thumbnails (hash TEXT PRIMARY KEY, data BLOB NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)')
+    c.execute('ALTER TABLE scans ADD COLUMN thumb_hash TEXT')
+    last_id = 0
+    while True:
+        rows = c.execute('SELECT id, thumb FROM scans WHERE thumb IS NOT NULL AND id > ? ORDER BY id LIMIT 500', (last_id,)).fetchall()
+        if not rows: break
+        for scan_id, data in rows:
+            c.execute('UPDATE scans SET thumb_hash=?, thumb=NULL WHERE id=?', (store_thumbnail(c, data), scan_id))
+        last_id = rows[-1][0]
+    # History is now keyset-paginated on (ts, id) and reads thumb_hash instead of thumb
+    c.execute('DROP INDEX IF EXISTS idx_scans_history')
+    c.execute('CREATE INDEX idx_scans_history ON scans(user_id, deleted, ts DESC, id DESC, scan_id, product, brand, score, verdict, favorite, thumb_hash)')
+
+def _migrate_barcode_cache_expiry(c):
+    for col, decl in [('expires_at', 'DATETIME'), ('last_accessed', 'DATETIME'), ('size_bytes', 'INTEGER DEFAULT 0')]:
+        c.execute(f'ALTER TABLE barcode_cache ADD COLUMN {col} {decl}')
+    c.execute("UPDATE barcode_cache SET last_accessed = last_updated, size_bytes = length(COALESCE(product_name, '') || COALESCE(brand, '') || COALESCE(ingredients, '') || COALESCE(categories, '') || COALESCE(nutrition, '') || COALESCE(image_url, '') || COALESCE(description, ''))")
+    for source, days in BARCODE_CACHE_TTL_DAYS.items():
+        c.execute('UPDATE barcode_cache SET expires_at = datetime(last_updated, ?) WHERE source = ?', (f'+{days} days', source))
+    c.execute('UPDATE barcode_cache SET expires_at = datetime(last_updated, ?) WHERE expires_at IS NULL', (f'+{BARCODE_CACHE_DEFAULT_TTL_DAYS} days',))
+    c.execute('CREATE INDEX IF NOT EXISTS idx_barcode_cache_expires ON barcode_cache(expires_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_barcode_cache_lru ON barcode_cache(last_accessed, size_bytes)')
+
+def _migrate_barcode_misses(c):
+    c.execute('CREATE TABLE IF NOT EXISTS barcode_misses (barcode TEXT NOT NULL, provider TEXT NOT NULL, expires_at DATETIME NOT NULL, PRIMARY KEY (barcode, provider)) WITHOUT ROWID')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_barcode_misses_expires ON barcode_misses(expires_at)')
+
+def _migrate_scan_log_outbox(c):
+    c.execute('CREATE TABLE IF NOT EXISTS scan_log_outbox (scan_id TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, attempts INTEGER DEFAULT 0)')
+
+def _migrate_global_scans_replica(c):
+    c.execute('CREATE TABLE IF NOT EXISTS global_scans (id INTEGER PRIMARY KEY, lat REAL, lon REAL, geohash TEXT, score INTEGER, verdict TEXT, city TEXT, country TEXT, product_name TEXT, created_at TEXT NOT NULL)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_global_scans_created ON global_scans(created_at DESC, id DESC)')
+    c.execute('CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT, updated_at DATETIME DEFAULT CURRENT_TIMESTAMP) WITHOUT ROWID')
+
+def _migrate_map_clustering(c):
+    # Clusters group by geohash prefix, so every located row needs one; scan_id lets the
+    # map drop replica rows that are this server's own scans
+    if 'scan_id' not in {col[1] for col in c.execute('PRAGMA table_info(global_scans)')}:
+        c.execute('ALTER TABLE global_scans ADD COLUMN scan_id TEXT')
+    for table, key in [('scans', 'id'), ('global_scans', 'id')]:
+        rows = c.execute(f'SELECT {key}, lat, lon FROM {table} WHERE geohash IS NULL AND lat IS NOT NULL AND lon IS NOT NULL').fetchall()
+        if rows:
+            keys, lats, lons = zip(*rows)
+            c.executemany(f'UPDATE {table} SET geohash = ? WHERE {key} = ?', zip(map(str, encode_geohash_array(lats, lons)), keys))
+
+SPATIAL_TABLES = ['scans', 'global_scans']
+
+def _migrate_spatial_index(c):
+    # One R*Tree per located table, kept in step by triggers; builds without the rtree
+    # module skip this and the spatial queries fall back to lat/lon range scans
+    for table in SPATIAL_TABLES:
+        try:
+            c.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {table}_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+        except sqlite3.OperationalError as e:
+            print(f"Spatial index unavailable: {e}")
+            return
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_rtree_insert AFTER INSERT ON {table} WHEN new.lat IS NOT NULL AND new.lon IS NOT NULL
+            BEGIN INSERT OR REPLACE INTO {table}_rtree VALUES (new.id, new.lat, new.lat, new.lon, new.lon); END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_rtree_update AFTER UPDATE OF lat, lon ON {table}
+            BEGIN DELETE FROM {table}_rtree WHERE id = old.id;
+            INSERT INTO {table}_rtree SELECT new.id, new.lat, new.lat, new.lon, new.lon WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL; END''')
+        c.execute(f'CREATE TRIGGER IF NOT EXISTS {table}_rtree_delete AFTER DELETE ON {table} BEGIN DELETE FROM {table}_rtree WHERE id = old.id; END')
+        c.execute(f'INSERT OR REPLACE INTO {table}_rtree SELECT id, lat, lat, lon, lon FROM {table} WHERE lat IS NOT NULL AND lon IS NOT NULL')
+
+def _migrate_analysis_cache(c):
+    c.execute('CREATE TABLE IF NOT EXISTS analysis_cache (key TEXT PRIMARY KEY, kind TEXT NOT NULL, subject TEXT NOT NULL, prompt_version TEXT NOT NULL, model TEXT NOT NULL, result TEXT NOT NULL, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, last_accessed DATETIME DEFAULT CURRENT_TIMESTAMP, expires_at DATETIME NOT NULL, hits INTEGER DEFAULT 0)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_analysis_cache_expires ON analysis_cache(expires_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_analysis_cache_version ON analysis_cache(prompt_version, model)')
+
+def _migrate_consensus_stats(c):
+    # Running mean/variance of the model's score per product, so the scan flow can tell a settled
+    # consensus from a noisy one; seeded from the local scan history where there is one
+    for col, decl in [('score_mean', 'REAL'), ('score_var', 'REAL'), ('last_result', 'TEXT')]:
+        c.execute(f'ALTER TABLE verified_products ADD COLUMN {col} {decl}')
+    history = 'FROM scans WHERE scans.product_hash = verified_products.product_hash'
+    c.execute(f'''UPDATE verified_products SET score_mean = COALESCE((SELECT AVG(score) {history}), verified_score),
+                 score_var = (SELECT MAX(AVG(score * score) - AVG(score) * AVG(score), 0) {history})''')
+
+# Append-only: never edit or reorder a released migration, add a new version instead
+SCHEMA_MIGRATIONS = [
+    (1, _migrate_base_tables),
+    (2, _migrate_scan_column_types),
+    (3, _migrate_hot_query_indexes),
+    (4, _migrate_thumbnail_store),
+    (5, _migrate_barcode_cache_expiry),
+    (6, _migrate_barcode_misses),
+    (7, _migrate_scan_log_outbox),
+    (8, _migrate_global_scans_replica),
+    (9, _migrate_map_clustering),
+    (10, _migrate_spatial_index),
+    (11, _migrate_analysis_cache),
+    (12, _migrate_consensus_stats),
+]
+
+def migrate_db():
+    """Apply pending SCHEMA_MIGRATIONS, each in its own transaction, and return the schema version."""
+    with db_transaction() as c:
+        c.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)')
+    version = 0
+    for target, migration in SCHEMA_MIGRATIONS:
+        with db_transaction() as c:
+            version = c.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+            if version >= target: continue
+            migration(c)
+            c.execute('INSERT INTO schema_version (version) VALUES (?)', (target,))
+            version = target
+    with db_connection() as conn:
+        conn.execute('PRAGMA optimize')
+    return version
+
+@st.cache_resource
+def _schema_version(path):
+    return migrate_db()
+
+def init_db():
+    """Migrate LOCAL_DB to the latest schema; runs once per process, later calls are free."""
+    return _schema_version(str(LOCAL_DB))
+
+def store_thumbnail(c, data):
+    """Store thumbnail bytes once per distinct image and return their content hash."""
+    if not data: return None
+    thumb_hash = hashlib.sha256(data).hexdigest()
+    c.execute('INSERT OR IGNORE INTO thumbnails (hash, data) VALUES (?, ?)', (thumb_hash, data))
+    return thumb_hash
+
+def get_thumbnail(thumb_hash):
+    if not thumb_hash: return None
+    r = db_query_one('SELECT data FROM thumbnails WHERE hash = ?', (thumb_hash,))
+    return r[0] if r else None
+
+@st.cache_data(show_spinner=False)
 def get_user_id():
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM user_info WHERE id=1')
-    r = c.fetchone()
-    conn.close()
+    r = db_query_one('SELECT user_id FROM user_info WHERE id=1')
     return r[0] if r else str(uuid.uuid4())
 
+@st.cache_data(show_spinner=False)
 def get_saved_location():
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT city, country, country_code, lat, lon FROM user_info WHERE id=1')
-    r = c.fetchone()
-    conn.close()
+    r = db_query_one('SELECT city, country, country_code, lat, lon FROM user_info WHERE id=1')
     if r and r[0] and r[0] not in ['Unknown', '']:
         code = r[2] or 'OTHER'
         return {'city': r[0], 'country': r[1] or '', 'code': code, 'retailers': RETAILERS_DISPLAY.get(code, RETAILERS_DISPLAY['OTHER']), 'lat': r[3], 'lon': r[4]}
@@ -714,140 +1409,192 @@ def get_saved_location():
 def save_location(city, country, lat=None, lon=None):
     country_map = {'australia': 'AU', 'united states': 'US', 'usa': 'US', 'united kingdom': 'GB', 'uk': 'GB', 'new zealand': 'NZ', 'canada': 'CA'}
     code = country_map.get((country or '').lower(), 'OTHER')
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('UPDATE user_info SET city=?, country=?, country_code=?, lat=?, lon=? WHERE id=1', (city, country, code, lat, lon))
-    conn.commit()
-    conn.close()
+    with db_transaction() as c:
+        c.execute('UPDATE user_info SET city=?, country=?, country_code=?, lat=?, lon=? WHERE id=1', (city, country, code, lat, lon))
+    get_saved_location.clear()
     return code
 
 def get_verified_score(product_name, brand=""):
     try:
         product_hash = get_product_hash(product_name, brand)
-        conn = sqlite3.connect(LOCAL_DB)
-        c = conn.cursor()
-        c.execute('SELECT verified_score, scan_count, violations FROM verified_products WHERE product_hash = ?', (product_hash,))
-        r = c.fetchone()
-        conn.close()
+        r = db_query_one('SELECT verified_score, scan_count, violations FROM verified_products WHERE product_hash = ?', (product_hash,))
         if r and r[1] >= 2: return {'score': r[0], 'scan_count': r[1], 'violations': json.loads(r[2]) if r[2] else []}
     except: pass
     return None
 
+def _upsert_verified_score(c, result):
+    """Fold one analysis into the product's weighted consensus score (single UPSERT, no read-modify-write).
+    
+    score_mean/score_var use the same weights: exact (Welford) for the first three analyses,
+    then exponentially weighted, so the variance tracks the score the consensus serves.
+    """
+    product_name, brand = result.get('product_name', ''), result.get('brand', '')
+    weight = 'CASE WHEN scan_count >= 3 THEN 0.9 ELSE scan_count * 1.0 / (scan_count + 1) END'
+    delta = '(excluded.score_mean - COALESCE(score_mean, verified_score))'
+    last = dict({k: v for k, v in result.items() if k not in CONSENSUS_VOLATILE_KEYS}, prompt_version=ANALYSIS_PROMPT_VERSION)
+    c.execute(f'''INSERT INTO verified_products (product_hash, product_name, brand, verified_score, product_category, ingredients, violations, score_mean, score_var, last_result) VALUES (?,?,?,?,?,?,?,?,0,?)
+                 ON CONFLICT(product_hash) DO UPDATE SET verified_score = CAST(verified_score * {weight} + excluded.verified_score * (1 - {weight}) AS INTEGER), scan_count = scan_count + 1, last_verified = CURRENT_TIMESTAMP, violations = excluded.violations,
+                 score_var = {weight} * (COALESCE(score_var, 0) + (1 - {weight}) * {delta} * {delta}), score_mean = COALESCE(score_mean, verified_score) + (1 - {weight}) * {delta}, last_result = excluded.last_result''',
+              (get_product_hash(product_name, brand), product_name, brand, result.get('score', 70), result.get('product_category', ''), json.dumps(result.get('ingredients', [])), json.dumps(result.get('violations', [])), result.get('score', 70), json.dumps(last, default=str)))
+
+def feeds_consensus(result):
+    """Only fresh, complete model analyses count; replays from a cache or the consensus itself would echo it back."""
+    return not (result.get('from_consensus') or result.get('from_cache') or result.get('fallback') or result.get('truncated'))
+
 def save_verified_score(result):
+    if not feeds_consensus(result): return
     try:
-        product_name, brand = result.get('product_name', ''), result.get('brand', '')
-        product_hash = get_product_hash(product_name, brand)
-        score = result.get('score', 70)
-        conn = sqlite3.connect(LOCAL_DB)
-        c = conn.cursor()
-        c.execute('SELECT verified_score, scan_count FROM verified_products WHERE product_hash = ?', (product_hash,))
-        existing = c.fetchone()
-        if existing:
-            old_score, count = existing
-            weight = 0.9 if count >= 3 else count / (count + 1)
-            new_score = int(old_score * weight + score * (1 - weight))
-            c.execute('UPDATE verified_products SET verified_score=?, scan_count=?, last_verified=CURRENT_TIMESTAMP, violations=? WHERE product_hash=?', (new_score, count + 1, json.dumps(result.get('violations', [])), product_hash))
-        else:
-            c.execute('INSERT INTO verified_products (product_hash, product_name, brand, verified_score, product_category, ingredients, violations) VALUES (?,?,?,?,?,?,?)', (product_hash, product_name, brand, score, result.get('product_category', ''), json.dumps(result.get('ingredients', [])), json.dumps(result.get('violations', []))))
-        conn.commit()
-        conn.close()
+        with db_transaction() as c:
+            _upsert_verified_score(c, result)
     except: pass
 
-def save_scan(result, user_id, thumb=None, location=None):
+def _record_scan_stats(c, verdict):
+    today = datetime.now().date()
+    streak = 'CASE WHEN last_scan = :yesterday THEN streak + 1 WHEN last_scan = :today THEN streak ELSE 1 END'
+    c.execute(f'UPDATE stats SET scans = scans + 1, flagged = flagged + :flagged, streak = {streak}, best_streak = MAX(best_streak, {streak}), last_scan = :today WHERE id=1',
+              {'today': today.isoformat(), 'yesterday': (today - timedelta(days=1)).isoformat(), 'flagged': 1 if verdict in ['HIGH_CAUTION', 'CAUTION'] else 0})
+
+def commit_scan(result, user_id, thumb=None, location=None, barcode=None, barcode_data=None):
+    """Persist a finished scan as one transaction: scan row, stats, verified-product consensus and,
+    for contributed products, the barcode cache entry. Returns the new scan id."""
     sid = f"HW-{uuid.uuid4().hex[:8].upper()}"
     product_hash = get_product_hash(result.get('product_name', ''), result.get('brand', ''))
     lat = location.get('lat') if location else None
     lon = location.get('lon') if location else None
-    geohash = location.get('geohash') if location else None
+    geohash = (location.get('geohash') or (encode_geohash(lat, lon) if lat is not None and lon is not None else None)) if location else None
     city = location.get('city') if location else None
     country = location.get('country') if location else None
     
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('''INSERT INTO scans (scan_id, user_id, product, brand, product_hash, product_category, product_type, score, verdict, ingredients, violations, bonuses, notifications, thumb, lat, lon, geohash, city, country, implied_promise, value_discrepancy, health_grade) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
-              (sid, user_id, result.get('product_name', ''), result.get('brand', ''), product_hash, result.get('product_category', ''), result.get('product_type', ''), result.get('score', 0), result.get('verdict', ''), json.dumps(result.get('ingredients', [])), json.dumps(result.get('violations', [])), json.dumps(result.get('bonuses', [])), json.dumps(result.get('notifications', [])), thumb, lat, lon, geohash, city, country, result.get('implied_promise', ''), 1 if result.get('value_discrepancy') else 0, result.get('health_grade', '')))
-    
-    today = datetime.now().date()
-    c.execute('SELECT scans, flagged, streak, best_streak, last_scan FROM stats WHERE id=1')
-    r = c.fetchone()
-    if r:
-        scans, flagged, streak, best, last = r
-        if last:
-            try:
-                ld = datetime.strptime(last, '%Y-%m-%d').date()
-                streak = streak + 1 if ld == today - timedelta(days=1) else (streak if ld == today else 1)
-            except: streak = 1
-        else: streak = 1
-        best = max(best, streak)
-        if result.get('verdict') in ['HIGH_CAUTION', 'CAUTION']: flagged += 1
-        c.execute('UPDATE stats SET scans=?, flagged=?, streak=?, best_streak=?, last_scan=? WHERE id=1', (scans + 1, flagged, streak, best, today.isoformat()))
-    conn.commit()
-    conn.close()
-    save_verified_score(result)
+    with db_transaction() as c:
+        c.execute('''INSERT INTO scans (scan_id, user_id, product, brand, product_hash, product_category, product_type, score, verdict, ingredients, violations, bonuses, notifications, thumb_hash, lat, lon, geohash, city, country, implied_promise, value_discrepancy, health_grade) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', 
+                  (sid, user_id, result.get('product_name', ''), result.get('brand', ''), product_hash, result.get('product_category', ''), result.get('product_type', ''), result.get('score', 0), result.get('verdict', ''), json.dumps(result.get('ingredients', [])), json.dumps(result.get('violations', [])), json.dumps(result.get('bonuses', [])), json.dumps(result.get('notifications', [])), store_thumbnail(c, thumb), lat, lon, geohash, city, country, result.get('implied_promise', ''), 1 if result.get('value_discrepancy') else 0, result.get('health_grade', '')))
+        _record_scan_stats(c, result.get('verdict'))
+        if feeds_consensus(result): _upsert_verified_score(c, result)
+        if barcode and barcode_data:
+            _upsert_barcode(c, barcode, barcode_data)
+            c.execute('DELETE FROM barcode_misses WHERE barcode = ?', (barcode,))
+    if barcode and barcode_data:
+        remember_barcode(barcode, barcode_data)
+    get_stats.clear()
+    get_history.clear()
+    invalidate_map_caches()
     return sid
 
-def get_history(user_id, n=30):
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT id, scan_id, ts, product, brand, score, verdict, thumb, favorite FROM scans WHERE user_id=? AND deleted=0 ORDER BY ts DESC LIMIT ?', (user_id, n))
-    rows = c.fetchall()
-    conn.close()
-    return [{'db_id': r[0], 'id': r[1], 'ts': r[2], 'product': r[3], 'brand': r[4], 'score': r[5], 'verdict': r[6], 'thumb': r[7], 'favorite': r[8]} for r in rows]
+HISTORY_PAGE_SIZE = 30
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_history(user_id, n=HISTORY_PAGE_SIZE, before=None):
+    """Newest-first page of scans. Pass the last item's 'cursor' as `before` to get the next page."""
+    sql = 'SELECT id, scan_id, ts, product, brand, score, verdict, thumb_hash, favorite FROM scans WHERE user_id=? AND deleted=0'
+    if before:
+        rows = db_query(sql + ' AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC LIMIT ?', (user_id, before[0], before[1], n))
+    else:
+        rows = db_query(sql + ' ORDER BY ts DESC, id DESC LIMIT ?', (user_id, n))
+    return [{'db_id': r[0], 'id': r[1], 'ts': r[2], 'product': r[3], 'brand': r[4], 'score': r[5], 'verdict': r[6], 'thumb_hash': r[7], 'favorite': r[8], 'cursor': (r[2], r[0])} for r in rows]
+
+def get_sync_state(name):
+    r = db_query_one('SELECT value FROM sync_state WHERE name = ?', (name,))
+    return r[0] if r else None
+
+def set_sync_state(c, name, value):
+    c.execute('INSERT INTO sync_state (name, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at', (name, value))
 
+@st.cache_data(show_spinner=False, max_entries=16)
 def get_map_data(limit=500):
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT lat, lon, geohash, score, verdict, city, country, product, ts FROM scans WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY ts DESC LIMIT ?', (limit,))
-    rows = c.fetchall()
-    conn.close()
+    rows = db_query('SELECT lat, lon, geohash, score, verdict, city, country, product, ts FROM scans WHERE lat IS NOT NULL AND lon IS NOT NULL ORDER BY ts DESC LIMIT ?', (limit,))
     return [{'lat': r[0], 'lon': r[1], 'geohash': r[2], 'score': r[3], 'verdict': r[4], 'city': r[5], 'country': r[6], 'product': r[7], 'ts': r[8]} for r in rows]
 
+@st.cache_data(show_spinner=False)
 def get_stats():
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT scans, flagged, streak, best_streak FROM stats WHERE id=1')
-    r = c.fetchone()
-    conn.close()
+    r = db_query_one('SELECT scans, flagged, streak, best_streak FROM stats WHERE id=1')
     return {'scans': r[0], 'flagged': r[1], 'streak': r[2], 'best_streak': r[3]} if r else {'scans': 0, 'flagged': 0, 'streak': 0, 'best_streak': 0}
 
+@st.cache_data(show_spinner=False)
 def get_allergies():
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT a FROM allergies')
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+    return [r[0] for r in db_query('SELECT a FROM allergies')]
 
 def save_allergies(allergies):
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('DELETE FROM allergies')
-    for a in allergies: c.execute('INSERT OR IGNORE INTO allergies (a) VALUES (?)', (a,))
-    conn.commit()
-    conn.close()
+    with db_transaction() as c:
+        c.execute('DELETE FROM allergies')
+        c.executemany('INSERT OR IGNORE INTO allergies (a) VALUES (?)', [(a,) for a in allergies])
+    get_allergies.clear()
 
+@st.cache_data(show_spinner=False)
 def get_profiles():
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('SELECT p FROM profiles')
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+    return [r[0] for r in db_query('SELECT p FROM profiles')]
 
 def save_profiles(profiles):
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('DELETE FROM profiles')
-    for p in profiles: c.execute('INSERT OR IGNORE INTO profiles (p) VALUES (?)', (p,))
-    conn.commit()
-    conn.close()
+    with db_transaction() as c:
+        c.execute('DELETE FROM profiles')
+        c.executemany('INSERT OR IGNORE INTO profiles (p) VALUES (?)', [(p,) for p in profiles])
+    get_profiles.clear()
 
 def toggle_favorite(db_id, current):
-    conn = sqlite3.connect(LOCAL_DB)
-    c = conn.cursor()
-    c.execute('UPDATE scans SET favorite = ? WHERE id = ?', (0 if current else 1, db_id))
-    conn.commit()
-    conn.close()
+    with db_transaction() as c:
+        c.execute('UPDATE scans SET favorite = ? WHERE id = ?', (0 if current else 1, db_id))
+    get_history.clear()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# SPATIAL QUERIES
+# ═══════════════════════════════════════════════════════════════════════════════
+EARTH_RADIUS_KM = 6371.0
+NEARBY_RADIUS_KM = 25
+FLAGGED_VERDICTS = ('HIGH_CAUTION', 'CAUTION')
+
+@st.cache_resource
+def _spatial_index_available(path):
+    return db_query_one("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('scans_rtree', 'global_scans_rtree')")[0] == len(SPATIAL_TABLES)
+
+def _bbox_rows(min_lat, max_lat, min_lon, max_lon, limit):
+    """Located local and (not self-originated) replica scans inside one non-wrapping box."""
+    box = (min_lat, max_lat, min_lon, max_lon)
+    if _spatial_index_available(str(LOCAL_DB)):
+        local_from = 'scans_rtree r JOIN scans s ON s.id = r.id'
+        global_from = 'global_scans_rtree r JOIN global_scans g ON g.id = r.id'
+        probe = 'r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? AND '
+        params = box + box
+    else:
+        local_from, global_from, probe, params = 'scans s', 'global_scans g', '', box
+    # R*Tree boxes are float32 and rounded outward, so the exact range check stays
+    rows = db_query(f'''SELECT s.lat, s.lon, s.geohash, s.score, s.verdict, s.city, s.country, s.product, s.ts, 'local' FROM {local_from}
+        WHERE {probe}s.lat BETWEEN ? AND ? AND s.lon BETWEEN ? AND ? LIMIT ?''', params + (limit,))
+    rows += db_query(f'''SELECT g.lat, g.lon, g.geohash, g.score, g.verdict, g.city, g.country, g.product_name, g.created_at, 'global' FROM {global_from}
+        WHERE {probe}g.lat BETWEEN ? AND ? AND g.lon BETWEEN ? AND ? AND (g.scan_id IS NULL OR g.scan_id NOT IN (SELECT scan_id FROM scans WHERE scan_id IS NOT NULL)) LIMIT ?''', params + (limit,))
+    return rows
+
+def get_scans_in_bbox(min_lat, max_lat, min_lon, max_lon, limit=500):
+    """Scans inside a lat/lon box; min_lon > max_lon means the box crosses the antimeridian."""
+    boxes = [(min_lon, max_lon)] if min_lon <= max_lon else [(min_lon, 180.0), (-180.0, max_lon)]
+    rows = [row for lo, hi in boxes for row in _bbox_rows(min_lat, max_lat, lo, hi, limit)][:limit]
+    return [{'lat': r[0], 'lon': r[1], 'geohash': r[2], 'score': r[3], 'verdict': r[4], 'city': r[5], 'country': r[6], 'product': r[7], 'ts': r[8], 'source': r[9]} for r in rows]
+
+def get_scans_near(lat, lon, radius_km, limit=200):
+    """Scans within `radius_km` great-circle distance, nearest first, with 'distance_km'."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    coslat = math.cos(math.radians(lat))
+    dlon = 180.0 if abs(lat) + dlat >= 90 or coslat < 1e-6 else min(180.0, dlat / coslat)
+    min_lon, max_lon = ((lon - dlon + 180) % 360 - 180, (lon + dlon + 180) % 360 - 180) if dlon < 180 else (-180.0, 180.0)
+    # Every candidate in the box is needed before ranking by distance
+    scans = get_scans_in_bbox(max(-90.0, lat - dlat), min(90.0, lat + dlat), min_lon, max_lon, limit=1_000_000)
+    if not scans: return []
+    lats, lons = np.radians([d['lat'] for d in scans]), np.radians([d['lon'] for d in scans])
+    a = np.sin((lats - math.radians(lat)) / 2) ** 2 + math.cos(math.radians(lat)) * np.cos(lats) * np.sin((lons - math.radians(lon)) / 2) ** 2
+    dist = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    order = [i for i in np.argsort(dist, kind='stable') if dist[i] <= radius_km][:limit]
+    return [dict(scans[i], distance_km=round(float(dist[i]), 2)) for i in order]
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_nearby_flagged_products(lat, lon, radius_km=NEARBY_RADIUS_KM, limit=10):
+    """Products flagged (caution or worse) near a point, most often flagged first."""
+    products = {}
+    for d in get_scans_near(lat, lon, radius_km, limit=1_000_000):
+        if d['verdict'] not in FLAGGED_VERDICTS or not d.get('product'): continue
+        p = products.setdefault(d['product'], {'product': d['product'], 'count': 0, 'score_total': 0, 'high_caution': 0, 'distance_km': d['distance_km'], 'city': d.get('city') or ''})
+        p['count'] += 1
+        p['score_total'] += d.get('score') or 0
+        p['high_caution'] += d['verdict'] == 'HIGH_CAUTION'
+    ranked = sorted(products.values(), key=lambda p: (-p['count'], p['distance_km']))[:limit]
+    return [dict(p, avg_score=round(p.pop('score_total') / p['count'])) for p in ranked]
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # SUPABASE FUNCTIONS
@@ -858,13 +1605,18 @@ def supa_ok():
 def supa_headers():
     return {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}", "Content-Type": "application/json", "Prefer": "return=minimal"}
 
+def check_upstream(r):
+    """Raise on throttling and server errors so an outage is never mistaken for 'not found'."""
+    if r.status_code == 429 or r.status_code >= 500: r.raise_for_status()
+    return r
+
 def supabase_lookup_barcode(barcode):
     """Look up product by barcode in Supabase products table"""
     if not supa_ok(): return None
     try:
         url = f"{SUPABASE_URL}/rest/v1/products?barcode=eq.{barcode}"
         headers = {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"}
-        r = requests.get(url, headers=headers, timeout=10)
+        r = check_upstream(http_get(url, headers=headers, breaker='supabase'))
         if r.ok:
             data = r.json()
             if data and len(data) > 0:
@@ -890,6 +1642,7 @@ def supabase_lookup_barcode(barcode):
                     'confidence': 'high', 
                     'crowdsourced': True
                 }
+    except requests.RequestException: raise
     except Exception as e:
         print(f"Supabase lookup error: {e}")
     return None
@@ -920,28 +1673,92 @@ def supabase_save_product(barcode, product_data, user_id):
             "contributed_by": user_id, 
             "created_at": datetime.now().isoformat()
         }
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
+        r = http_post(url, headers=headers, json=payload, breaker='supabase')
         return r.ok
     except Exception as e:
         print(f"Supabase save error: {e}")
         return False
 
-def supabase_get_global_scans(limit=1000):
-    if not supa_ok(): return []
-    try:
-        url = f"{SUPABASE_URL}/rest/v1/scans_log?select=lat,lon,geohash,score,verdict,city,country,product_name,created_at&lat=not.is.null&order=created_at.desc&limit={limit}"
-        headers = {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"}
-        r = requests.get(url, headers=headers, timeout=15)
-        if r.ok: return r.json()
-    except: pass
-    return []
-
-def cloud_log_scan(result, location, user_id):
-    """Log scan to Supabase scans_log table for global map and analytics"""
+# The map reads scans_log from the local global_scans replica, which a background worker
+# keeps current by paging forward from an id high-water mark. The mark is the identity Supabase
+# assigns on insert; created_at is the client's scan time, and outbox-delayed events arrive
+# with created_at far behind newer rows, so it cannot be the sync key
+GLOBAL_SCANS_COLUMNS = ['id', 'lat', 'lon', 'geohash', 'score', 'verdict', 'city', 'country', 'product_name', 'created_at', 'scan_id']
+GLOBAL_SCANS_PAGE_SIZE = 1000
+GLOBAL_SCANS_MAX_PAGES = 10
+GLOBAL_SCANS_MAX_ROWS = 20000
+GLOBAL_SCANS_SYNC_INTERVAL = 60
+GLOBAL_SCANS_SYNC_KEY = 'global_scans_id'  # replaces the old (created_at, id) mark under 'global_scans'
+
+def supabase_fetch_scans_log(after=None, limit=GLOBAL_SCANS_PAGE_SIZE):
+    """Located scans_log rows with id above `after`, in insertion order.
+    
+    Without `after`, returns the newest `limit` rows (the initial backfill).
+    """
+    params = {'select': ','.join(GLOBAL_SCANS_COLUMNS), 'lat': 'not.is.null', 'limit': limit}
+    if after is not None:
+        params['id'] = f'gt.{int(after)}'
+        params['order'] = 'id.asc'
+    else:
+        params['order'] = 'id.desc'
+    headers = {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"}
+    r = check_upstream(http_get(f"{SUPABASE_URL}/rest/v1/scans_log", headers=headers, params=params, timeout=(3.05, 15), breaker='supabase'))
+    r.raise_for_status()
+    return r.json()
+
+def _fill_geohashes(rows):
+    missing = [d for d in rows if not d.get('geohash') and d.get('lat') is not None and d.get('lon') is not None]
+    if missing:
+        for d, gh in zip(missing, encode_geohash_array([d['lat'] for d in missing], [d['lon'] for d in missing])): d['geohash'] = str(gh)
+    return rows
+
+def sync_global_scans():
+    """Pull new scans_log rows into global_scans; returns the number of rows fetched."""
+    if not supa_ok(): return 0
+    mark = get_sync_state(GLOBAL_SCANS_SYNC_KEY)
+    after = int(mark) if mark else None
+    fetched = 0
+    for _ in range(GLOBAL_SCANS_MAX_PAGES):
+        rows = supabase_fetch_scans_log(after)
+        if rows:
+            after = max(d['id'] for d in rows)
+            with db_transaction() as c:
+                c.executemany(f"INSERT INTO global_scans ({', '.join(GLOBAL_SCANS_COLUMNS)}) VALUES ({', '.join('?' * len(GLOBAL_SCANS_COLUMNS))}) ON CONFLICT(id) DO NOTHING",
+                              [tuple(d.get(k) for k in GLOBAL_SCANS_COLUMNS) for d in _fill_geohashes(rows)])
+                set_sync_state(c, GLOBAL_SCANS_SYNC_KEY, str(after))
+            fetched += len(rows)
+        if mark is None or len(rows) < GLOBAL_SCANS_PAGE_SIZE: break
+    if fetched:
+        with db_transaction() as c:
+            c.execute('DELETE FROM global_scans WHERE id NOT IN (SELECT id FROM global_scans ORDER BY id DESC LIMIT ?)', (GLOBAL_SCANS_MAX_ROWS,))
+        invalidate_map_caches()
+    return fetched
+
+@st.cache_resource
+def get_global_scans_wakeup():
+    wake = threading.Event()
+    wake.set()  # sync as soon as the worker starts
+    return wake
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_global_scans(limit=1000):
+    rows = db_query('SELECT lat, lon, geohash, score, verdict, city, country, product_name, created_at FROM global_scans ORDER BY created_at DESC, id DESC LIMIT ?', (limit,))
+    return [{'lat': r[0], 'lon': r[1], 'geohash': r[2], 'score': r[3], 'verdict': r[4], 'city': r[5], 'country': r[6], 'product_name': r[7], 'created_at': r[8]} for r in rows]
+
+# Scan-log events go to a local outbox and are bulk-inserted by a background flusher
+SCAN_LOG_BATCH_SIZE = 25
+SCAN_LOG_FLUSH_INTERVAL = 15
+SCAN_LOG_MAX_ATTEMPTS = 20  # definitive 4xx rejections before a row is parked
+SCAN_LOG_TRANSIENT_STATUS = (408, 425, 429)
+
+@st.cache_resource
+def get_scan_log_wakeup():
+    return threading.Event()
+
+def cloud_log_scan(result, location, user_id, scan_id):
+    """Queue a scan for the Supabase scans_log table (global map and analytics)"""
     if supa_ok():
         try:
-            url = f"{SUPABASE_URL}/rest/v1/scans_log"
-            headers = supa_headers()
             lat, lon = location.get('lat'), location.get('lon')
             if lat and lon:
                 lat, lon = add_privacy_jitter(lat, lon)
@@ -964,43 +1781,274 @@ def cloud_log_scan(result, location, user_id):
                 "lat": lat, 
                 "lon": lon, 
                 "geohash": geohash,
+                "scan_id": scan_id,
                 "created_at": datetime.now().isoformat()
             }
-            requests.post(url, headers=headers, json=payload, timeout=5)
+            with db_transaction() as c:
+                c.execute('INSERT OR IGNORE INTO scan_log_outbox (scan_id, payload) VALUES (?, ?)', (scan_id, json.dumps(payload)))
+                queued = c.execute('SELECT COUNT(*) FROM scan_log_outbox WHERE attempts < ?', (SCAN_LOG_MAX_ATTEMPTS,)).fetchone()[0]
+            if queued >= SCAN_LOG_BATCH_SIZE: get_scan_log_wakeup().set()
         except Exception as e:
             print(f"Cloud log error: {e}")
 
+def _send_scan_log(rows, url, headers, delivered, rejected):
+    """POST a batch of outbox rows, bisecting a definitively rejected batch down to the rows
+    Supabase refuses on their own. Returns False on an outage (open breaker, timeout, 5xx)."""
+    try:
+        r = http_post(url, headers=headers, data='[' + ','.join(row[1] for row in rows) + ']', retries=HTTP_MAX_RETRIES, breaker='supabase')
+        r.raise_for_status()
+        delivered.extend(row[0] for row in rows)
+        return True
+    except Exception as e:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        if not (status and 400 <= status < 500 and status not in SCAN_LOG_TRANSIENT_STATUS):
+            print(f"Cloud log flush error: {e}")
+            return False
+        if len(rows) == 1:
+            print(f"Cloud log rejected {rows[0][0]}: {e}")
+            rejected.append(rows[0][0])
+            return True
+        mid = len(rows) // 2
+        return _send_scan_log(rows[:mid], url, headers, delivered, rejected) and _send_scan_log(rows[mid:], url, headers, delivered, rejected)
+
+def flush_scan_log():
+    """Bulk-insert queued scan-log events; rows leave the outbox only once Supabase accepts them.
+    
+    scan_id is the idempotency key (on_conflict + ignore-duplicates), so a batch that
+    reached the server but whose response was lost is safe to resend. A row Supabase
+    rejects is isolated by bisecting its batch; only that row's attempts go up, and the
+    pass moves on past it, so it cannot hold back the rows queued behind it.
+    """
+    if not supa_ok(): return 0
+    url = f"{SUPABASE_URL}/rest/v1/scans_log?on_conflict=scan_id"
+    headers = dict(supa_headers(), Prefer="resolution=ignore-duplicates,return=minimal")
+    sent, cursor = 0, ('', '')
+    while True:
+        rows = db_query('SELECT scan_id, payload, created_at FROM scan_log_outbox WHERE attempts < ? AND (created_at, scan_id) > (?, ?) ORDER BY created_at, scan_id LIMIT ?',
+                        (SCAN_LOG_MAX_ATTEMPTS, *cursor, SCAN_LOG_BATCH_SIZE))
+        if not rows: return sent
+        delivered, rejected = [], []
+        ok = _send_scan_log(rows, url, headers, delivered, rejected)
+        with db_transaction() as c:
+            c.executemany('DELETE FROM scan_log_outbox WHERE scan_id = ?', [(i,) for i in delivered])
+            c.executemany('UPDATE scan_log_outbox SET attempts = attempts + 1 WHERE scan_id = ?', [(i,) for i in rejected])
+        sent += len(delivered)
+        if not ok: return sent
+        cursor = (rows[-1][2], rows[-1][0])
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# MAP AGGREGATION
+# ═══════════════════════════════════════════════════════════════════════════════
+# Scans are bucketed by geohash prefix, one precision per zoom band, so the map receives a
+# bounded number of cells however many scans exist. (min zoom, geohash precision):
+MAP_ZOOM_BANDS = [(0, 2), (5, 3), (8, 4), (11, 5), (14, 6)]
+MAP_MAX_CELLS = 250
+
+# Local scans plus replica rows that did not originate on this server
+MAP_LOCAL_WHERE = 'lat IS NOT NULL AND lon IS NOT NULL AND geohash IS NOT NULL'
+MAP_GLOBAL_WHERE = f'{MAP_LOCAL_WHERE} AND (scan_id IS NULL OR scan_id NOT IN (SELECT scan_id FROM scans WHERE scan_id IS NOT NULL))'
+MAP_POINTS_SQL = f'''SELECT geohash, lat, lon, score, verdict, city, product FROM scans WHERE {MAP_LOCAL_WHERE}
+    UNION ALL SELECT geohash, lat, lon, score, verdict, city, product_name FROM global_scans WHERE {MAP_GLOBAL_WHERE}'''
+
+def aggregate_map_cells(precision, limit=MAP_MAX_CELLS):
+    """Densest geohash cells at `precision` as [lat, lon, count, mean score, high caution, caution, city, product].
+    
+    lat/lon is the cell's centroid; product is only set for single-scan cells.
+    """
+    rows = db_query(f'''SELECT COUNT(*) AS n, AVG(lat), AVG(lon), AVG(score), SUM(verdict = 'HIGH_CAUTION'), SUM(verdict = 'CAUTION'), MAX(city), CASE WHEN COUNT(*) = 1 THEN MAX(product) END
+        FROM ({MAP_POINTS_SQL}) GROUP BY substr(geohash, 1, ?) ORDER BY n DESC LIMIT ?''', (precision, limit))
+    return [[round(r[1], 4), round(r[2], 4), r[0], round(r[3] or 0), r[4], r[5], r[6] or '', r[7] or ''] for r in rows]
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_map_clusters():
+    """Cluster cells for every zoom band plus headline counts, cleared by invalidate_map_caches().
+    
+    The counts use the map's own filters, so replica copies of this server's scans are not counted twice.
+    """
+    local, global_, cities = db_query_one(f'''SELECT (SELECT COUNT(*) FROM scans WHERE {MAP_LOCAL_WHERE}), (SELECT COUNT(*) FROM global_scans WHERE {MAP_GLOBAL_WHERE}),
+        (SELECT COUNT(DISTINCT city) FROM ({MAP_POINTS_SQL}) WHERE city IS NOT NULL AND city != '')''')
+    return {'bands': [[zoom, aggregate_map_cells(precision)] for zoom, precision in MAP_ZOOM_BANDS],
+            'local': local, 'global': global_, 'cities': cities}
+
+# Heat layer: verdict-weighted scan density on a lat/lon grid per zoom band (min zoom, cell
+# size in degrees). Grids are sparse, since a street-level world raster would not fit in memory.
+DENSITY_BANDS = [(0, 2.0), (4, 0.5), (7, 0.1), (10, 0.02)]
+DENSITY_MAX_CELLS = 600
+DENSITY_WEIGHTS = {'HIGH_CAUTION': 0.8}
+DENSITY_DEFAULT_WEIGHT = 0.5
+
+class DensityGrid:
+    """Sparse 2-D histograms, one per band, folded forward from per-table id high-water marks.
+    
+    New rows are binned and added on refresh(); anything else (trimmed replica rows,
+    out-of-order ids) shows up as a row-count mismatch and triggers a full rebuild.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rebuilds = 0
+        self._reset()
+
+    def _reset(self):
+        self.keys = [np.zeros(0, dtype=np.int64) for _ in DENSITY_BANDS]
+        self.weights = [np.zeros(0) for _ in DENSITY_BANDS]
+        self.marks = (0, 0)
+        self.counts = (0, 0)
+        self.seen = (0, 0)
+        self.payload = None
+
+    def _add(self, lats, lons, weights):
+        for band, (_, size) in enumerate(DENSITY_BANDS):
+            cols, rows = round(360 / size), round(180 / size)
+            ix = np.clip(((lons + 180) / size).astype(np.int64), 0, cols - 1)
+            iy = np.clip(((lats + 90) / size).astype(np.int64), 0, rows - 1)
+            self.keys[band], inverse = np.unique(np.concatenate([self.keys[band], iy * cols + ix]), return_inverse=True)
+            self.weights[band] = np.bincount(inverse, weights=np.concatenate([self.weights[band], weights]))
+
+    def refresh(self):
+        version = db_query_one('''SELECT (SELECT COUNT(*) FROM scans WHERE lat IS NOT NULL AND lon IS NOT NULL), (SELECT COUNT(*) FROM global_scans),
+            (SELECT COALESCE(MAX(id), 0) FROM scans), (SELECT COALESCE(MAX(id), 0) FROM global_scans)''')
+        counts = tuple(version[:2])
+        with self.lock:
+            if counts == self.counts and tuple(version[2:]) == self.seen: return
+            for attempt in range(2):
+                local = db_query('SELECT id, lat, lon, verdict, 1 FROM scans WHERE id > ? AND lat IS NOT NULL AND lon IS NOT NULL', (self.marks[0],))
+                remote = db_query('''SELECT id, lat, lon, verdict, lat IS NOT NULL AND lon IS NOT NULL AND (scan_id IS NULL OR scan_id NOT IN (SELECT scan_id FROM scans WHERE scan_id IS NOT NULL))
+                    FROM global_scans WHERE id > ?''', (self.marks[1],))
+                if attempt == 0 and (self.counts[0] + len(local), self.counts[1] + len(remote)) != counts:
+                    self._reset()
+                    self.rebuilds += 1
+                    continue
+                break
+            included = [row for row in local + remote if row[4]]
+            if included:
+                self._add(np.array([row[1] for row in included], dtype=np.float64), np.array([row[2] for row in included], dtype=np.float64),
+                          np.array([DENSITY_WEIGHTS.get(row[3], DENSITY_DEFAULT_WEIGHT) for row in included]))
+            self.marks = (max([self.marks[0]] + [row[0] for row in local]), max([self.marks[1]] + [row[0] for row in remote]))
+            self.counts = (self.counts[0] + len(local), self.counts[1] + len(remote))
+            self.seen = tuple(version[2:])
+            self.payload = None
+
+    def bands(self):
+        """[[min zoom, [[lat, lon, weight 0-1], ...]], ...] with each band's heaviest cells."""
+        with self.lock:
+            if self.payload is None:
+                self.payload = []
+                for band, (zoom, size) in enumerate(DENSITY_BANDS):
+                    keys, weights = self.keys[band], self.weights[band]
+                    top = np.argsort(weights, kind='stable')[::-1][:DENSITY_MAX_CELLS]
+                    cols = round(360 / size)
+                    lats = -90 + (keys[top] // cols + 0.5) * size
+                    lons = -180 + (keys[top] % cols + 0.5) * size
+                    norm = weights[top] / weights[top[0]] if len(top) else weights[top]
+                    self.payload.append([zoom, np.column_stack([lats.round(3), lons.round(3), norm.round(3)]).tolist()])
+            return self.payload
+
+@st.cache_resource
+def get_density_grid():
+    return DensityGrid()
+
+def invalidate_map_caches():
+    """Called whenever located scans change, locally or in the replica."""
+    for cached in (get_map_data, get_global_scans, get_nearby_flagged_products, get_map_clusters, get_density_bands): cached.clear()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def get_density_bands():
+    grid = get_density_grid()
+    grid.refresh()
+    return grid.bands()
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # BARCODE FUNCTIONS
 # ═══════════════════════════════════════════════════════════════════════════════
+# Tier 1 is an in-process LRU shared by every session; tier 2 is the barcode_cache table
+BARCODE_CACHE_TTL_DAYS = {'HonestWorld Community': 30, 'Open Library': 180, 'Open Food Facts': 7, 'Open Beauty Facts': 7, 'UPC Item DB': 14}
+BARCODE_CACHE_DEFAULT_TTL_DAYS = 7
+BARCODE_LRU_SIZE = 2048
+BARCODE_CACHE_MAX_ROWS = 50000
+BARCODE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+BARCODE_CACHE_EVICT_INTERVAL = 600
+BARCODE_READ_MEMO_SIZE = 8  # decoded frames remembered per session
+BARCODE_DETECT_EDGE = 1280  # longest side of the frame used to locate barcodes
+BARCODE_ROI_WIDTH = 720  # deskewed ROI length, ~6 px per EAN-13 module
+BARCODE_ROI_MAX_UPSCALE = 2.0
+BARCODE_MAX_REGIONS = 4
+BARCODE_DECODE_WORKERS = min(4, os.cpu_count() or 1)  # zbar and OpenCV release the GIL while decoding
+BARCODE_PYRAMID_MIN_EDGE = 640  # coarsest pyramid level tried first
+BARCODE_PYRAMID_MAX_EDGE = 4096  # finest level; bounds a full-frame attempt to ~3 x 16 MB
+
+def forget_barcode_reads(barcode):
+    """Drop this session's memoized frames for a barcode, e.g. once it has been contributed."""
+    reads = st.session_state.get('barcode_reads', {})
+    for digest in [d for d, read in reads.items() if read['barcode'] == barcode]: reads.pop(digest)
+
+@st.cache_resource
+def get_barcode_memory_cache():
+    return LRUCache(BARCODE_LRU_SIZE)
+
+def barcode_ttl_days(source):
+    return BARCODE_CACHE_TTL_DAYS.get(source, BARCODE_CACHE_DEFAULT_TTL_DAYS)
+
+def _barcode_cache_entry(data):
+    return {'found': True, 'name': data.get('name', ''), 'brand': data.get('brand', ''), 'ingredients': data.get('ingredients', ''), 'product_type': data.get('product_type', ''), 'categories': data.get('categories', ''), 'nutrition': data.get('nutrition') or {}, 'image_url': data.get('image_url', ''), 'source': data.get('source', ''), 'description': data.get('description', '') or '', 'cached': True}
+
+def _upsert_barcode(c, barcode, data):
+    nutrition = json.dumps(data.get('nutrition', {}))
+    values = (barcode, data.get('name', ''), data.get('brand', ''), data.get('ingredients', ''), data.get('product_type', ''), data.get('categories', ''), nutrition, data.get('image_url', ''), data.get('source', ''), data.get('description', ''))
+    c.execute('''INSERT INTO barcode_cache (barcode, product_name, brand, ingredients, product_type, categories, nutrition, image_url, source, description, last_updated, last_accessed, expires_at, size_bytes) VALUES (?,?,?,?,?,?,?,?,?,?,CURRENT_TIMESTAMP,CURRENT_TIMESTAMP,datetime('now', ?),?)
+                 ON CONFLICT(barcode) DO UPDATE SET product_name=excluded.product_name, brand=excluded.brand, ingredients=excluded.ingredients, product_type=excluded.product_type, categories=excluded.categories, nutrition=excluded.nutrition, image_url=excluded.image_url, source=excluded.source, description=excluded.description, last_updated=CURRENT_TIMESTAMP, last_accessed=CURRENT_TIMESTAMP, expires_at=excluded.expires_at, size_bytes=excluded.size_bytes''',
+              values + (f'+{barcode_ttl_days(data.get("source", ""))} days', sum(len(str(v or '')) for v in values[1:])))
+
+def remember_barcode(barcode, data):
+    """Put a barcode lookup into the in-process tier (call after it is committed to SQLite)."""
+    get_barcode_memory_cache().put(barcode, _barcode_cache_entry(data), barcode_ttl_days(data.get('source', '')) * 86400)
+
 def cache_barcode(barcode, data):
     try:
-        conn = sqlite3.connect(LOCAL_DB)
-        c = conn.cursor()
-        c.execute('INSERT OR REPLACE INTO barcode_cache (barcode, product_name, brand, ingredients, product_type, categories, nutrition, image_url, source, description, last_updated) VALUES (?,?,?,?,?,?,?,?,?,?,CURRENT_TIMESTAMP)', (barcode, data.get('name', ''), data.get('brand', ''), data.get('ingredients', ''), data.get('product_type', ''), data.get('categories', ''), json.dumps(data.get('nutrition', {})), data.get('image_url', ''), data.get('source', ''), data.get('description', '')))
-        conn.commit()
-        conn.close()
+        with db_transaction() as c:
+            _upsert_barcode(c, barcode, data)
+        remember_barcode(barcode, data)
     except: pass
 
 def get_cached_barcode(barcode):
+    memory = get_barcode_memory_cache()
+    hit = memory.get(barcode)
+    if hit: return hit
     try:
-        conn = sqlite3.connect(LOCAL_DB)
-        c = conn.cursor()
-        c.execute('SELECT product_name, brand, ingredients, product_type, categories, nutrition, image_url, source, description FROM barcode_cache WHERE barcode = ?', (barcode,))
-        r = c.fetchone()
-        conn.close()
+        r = db_query_one("SELECT product_name, brand, ingredients, product_type, categories, nutrition, image_url, source, description, CAST(strftime('%s', expires_at) AS INTEGER) - CAST(strftime('%s', 'now') AS INTEGER) FROM barcode_cache WHERE barcode = ? AND expires_at > CURRENT_TIMESTAMP", (barcode,))
         if r and r[0]:
-            return {'found': True, 'name': r[0], 'brand': r[1], 'ingredients': r[2], 'product_type': r[3], 'categories': r[4], 'nutrition': json.loads(r[5]) if r[5] else {}, 'image_url': r[6], 'source': r[7], 'description': r[8] or '', 'cached': True}
+            with db_transaction() as c:
+                c.execute('UPDATE barcode_cache SET last_accessed = CURRENT_TIMESTAMP WHERE barcode = ?', (barcode,))
+            entry = {'found': True, 'name': r[0], 'brand': r[1], 'ingredients': r[2], 'product_type': r[3], 'categories': r[4], 'nutrition': json.loads(r[5]) if r[5] else {}, 'image_url': r[6], 'source': r[7], 'description': r[8] or '', 'cached': True}
+            memory.put(barcode, entry, r[9])
+            memory.incr('db_hits')
+            return dict(entry)
     except: pass
+    memory.incr('db_misses')
     return None
 
+def evict_barcode_cache(max_rows=BARCODE_CACHE_MAX_ROWS, max_bytes=BARCODE_CACHE_MAX_BYTES):
+    """Drop expired rows, then least-recently-accessed rows until under the row and byte caps."""
+    with db_transaction() as c:
+        expired = c.execute('DELETE FROM barcode_cache WHERE expires_at <= CURRENT_TIMESTAMP').rowcount
+        c.execute('DELETE FROM barcode_misses WHERE expires_at <= CURRENT_TIMESTAMP')
+        over_rows = c.execute('DELETE FROM barcode_cache WHERE barcode IN (SELECT barcode FROM barcode_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)', (max_rows,)).rowcount
+        over_bytes = c.execute('''DELETE FROM barcode_cache WHERE barcode IN (SELECT barcode FROM (SELECT barcode, SUM(size_bytes) OVER (ORDER BY last_accessed DESC, barcode) AS running FROM barcode_cache) WHERE running > ?)''', (max_bytes,)).rowcount
+    memory = get_barcode_memory_cache()
+    memory.incr('db_expired', expired)
+    memory.incr('db_evicted', over_rows + over_bytes)
+    if expired or over_rows or over_bytes: print(f"Barcode cache evicted {expired + over_rows + over_bytes} rows: {barcode_cache_stats()}")
+
+def barcode_cache_stats():
+    """Counters for both tiers: memory hits/misses/evictions plus db_hits, db_misses, db_expired, db_evicted."""
+    return get_barcode_memory_cache().snapshot()
+
 def is_book_isbn(barcode):
     return barcode and len(barcode) >= 10 and barcode[:3] in ['978', '979']
 
-def lookup_open_food_facts(barcode, progress_callback=None):
-    if progress_callback: progress_callback(0.3, "🍎 Searching Open Food Facts...")
+def lookup_open_food_facts(barcode):
     try:
-        r = requests.get(f"https://world.openfoodfacts.org/api/v0/product/{barcode}.json", timeout=12)
+        r = check_upstream(http_get(f"https://world.openfoodfacts.org/api/v0/product/{barcode}.json", breaker='open_food_facts'))
         if r.ok:
             d = r.json()
             if d.get('status') == 1:
@@ -1008,26 +2056,26 @@ def lookup_open_food_facts(barcode, progress_callback=None):
                 name = p.get('product_name') or p.get('product_name_en') or p.get('generic_name') or ''
                 if name:
                     return {'found': True, 'name': name, 'brand': p.get('brands', ''), 'ingredients': p.get('ingredients_text') or p.get('ingredients_text_en') or '', 'categories': p.get('categories', ''), 'nutrition': p.get('nutriments', {}), 'image_url': p.get('image_url', ''), 'product_type': 'food', 'source': 'Open Food Facts', 'confidence': 'high' if p.get('ingredients_text') else 'medium'}
+    except requests.RequestException: raise
     except: pass
     return None
 
-def lookup_open_beauty_facts(barcode, progress_callback=None):
-    if progress_callback: progress_callback(0.4, "🧴 Searching Open Beauty Facts...")
+def lookup_open_beauty_facts(barcode):
     try:
-        r = requests.get(f"https://world.openbeautyfacts.org/api/v0/product/{barcode}.json", timeout=12)
+        r = check_upstream(http_get(f"https://world.openbeautyfacts.org/api/v0/product/{barcode}.json", breaker='open_beauty_facts'))
         if r.ok:
             d = r.json()
             if d.get('status') == 1:
                 p = d.get('product', {})
                 name = p.get('product_name') or p.get('product_name_en') or ''
                 if name: return {'found': True, 'name': name, 'brand': p.get('brands', ''), 'ingredients': p.get('ingredients_text') or p.get('ingredients_text_en') or '', 'categories': p.get('categories', ''), 'image_url': p.get('image_url', ''), 'product_type': 'cosmetics', 'source': 'Open Beauty Facts', 'confidence': 'high' if p.get('ingredients_text') else 'medium'}
+    except requests.RequestException: raise
     except: pass
     return None
 
-def lookup_open_library(barcode, progress_callback=None):
-    if progress_callback: progress_callback(0.5, "📚 Searching Open Library...")
+def lookup_open_library(barcode):
     try:
-        r = requests.get(f"https://openlibrary.org/api/books?bibkeys=ISBN:{barcode}&format=json&jscmd=data", timeout=12)
+        r = check_upstream(http_get(f"https://openlibrary.org/api/books?bibkeys=ISBN:{barcode}&format=json&jscmd=data", breaker='open_library'))
         if r.ok:
             d = r.json()
             key = f"ISBN:{barcode}"
@@ -1035,22 +2083,58 @@ def lookup_open_library(barcode, progress_callback=None):
                 book = d[key]
                 authors = ', '.join([a.get('name', '') for a in book.get('authors', [])]) if book.get('authors') else ''
                 return {'found': True, 'name': book.get('title', ''), 'brand': authors, 'ingredients': '', 'categories': 'Books', 'product_type': 'book', 'source': 'Open Library', 'confidence': 'high', 'is_book': True, 'publishers': ', '.join([p.get('name', '') for p in book.get('publishers', [])]) if book.get('publishers') else '', 'publish_date': book.get('publish_date', ''), 'pages': book.get('number_of_pages', '')}
+    except requests.RequestException: raise
     except: pass
     return None
 
-def lookup_upc_itemdb(barcode, progress_callback=None):
-    if progress_callback: progress_callback(0.6, "🔍 Searching UPC Database...")
+def lookup_upc_itemdb(barcode):
     try:
-        r = requests.get(f"https://api.upcitemdb.com/prod/trial/lookup?upc={barcode}", timeout=12)
+        r = check_upstream(http_get(f"https://api.upcitemdb.com/prod/trial/lookup?upc={barcode}", breaker='upc_itemdb'))
         if r.ok:
             d = r.json()
             items = d.get('items', [])
             if items:
                 item = items[0]
                 return {'found': True, 'name': item.get('title', ''), 'brand': item.get('brand', ''), 'description': item.get('description', ''), 'categories': item.get('category', ''), 'image_url': item.get('images', [''])[0] if item.get('images') else '', 'source': 'UPC Item DB', 'confidence': 'medium'}
+    except requests.RequestException: raise
     except: pass
     return None
 
+# How long a definitive "not found" from each provider is trusted. The community DB is
+# short because contributions land there; the public catalogues change slowly.
+BARCODE_NEGATIVE_TTL = {'supabase': 600, 'open_library': 86400, 'open_food_facts': 6 * 3600, 'open_beauty_facts': 6 * 3600, 'upc_itemdb': 86400}
+
+# Priority order; progress is reported from the calling thread while each provider is awaited
+BARCODE_PROVIDERS = [
+    ('supabase', supabase_lookup_barcode, 0.2, "🌍 Searching HonestWorld database..."),
+    ('open_library', lookup_open_library, 0.3, "📚 Searching Open Library..."),
+    ('open_food_facts', lookup_open_food_facts, 0.4, "🍎 Searching Open Food Facts..."),
+    ('open_beauty_facts', lookup_open_beauty_facts, 0.5, "🧴 Searching Open Beauty Facts..."),
+    ('upc_itemdb', lookup_upc_itemdb, 0.6, "🔍 Searching UPC Database..."),
+]
+BARCODE_LOOKUP_WORKERS = 16
+
+@st.cache_resource
+def get_lookup_executor():
+    return ThreadPoolExecutor(max_workers=BARCODE_LOOKUP_WORKERS, thread_name_prefix='hw-lookup')
+
+def barcode_providers(barcode):
+    """Providers that apply to this barcode, in priority order, minus any whose breaker is open."""
+    return [p for p in BARCODE_PROVIDERS if (p[0] != 'supabase' or supa_ok()) and (p[0] != 'open_library' or is_book_isbn(barcode)) and get_breaker(p[0]).available()]
+
+def get_barcode_misses(barcode):
+    return {r[0] for r in db_query('SELECT provider FROM barcode_misses WHERE barcode = ? AND expires_at > CURRENT_TIMESTAMP', (barcode,))}
+
+def record_barcode_misses(barcode, providers):
+    if not providers: return
+    try:
+        with db_transaction() as c:
+            c.executemany("INSERT INTO barcode_misses (barcode, provider, expires_at) VALUES (?, ?, datetime('now', ?)) ON CONFLICT(barcode, provider) DO UPDATE SET expires_at=excluded.expires_at",
+                          [(barcode, p, f'+{BARCODE_NEGATIVE_TTL.get(p, 3600)} seconds') for p in providers])
+    except: pass
+
+BARCODE_FOUND_MESSAGES = {'supabase': "✓ Found in HonestWorld!", 'open_library': "✓ Book found!"}
+
 def waterfall_barcode_search(barcode, progress_callback=None):
     if not barcode: return {'found': False, 'reason': 'No barcode provided'}
     
@@ -1060,68 +2144,246 @@ def waterfall_barcode_search(barcode, progress_callback=None):
         if progress_callback: progress_callback(1.0, "✓ Found in cache!")
         return cached
     
-    if progress_callback: progress_callback(0.2, "🌍 Searching HonestWorld database...")
-    supabase_result = supabase_lookup_barcode(barcode)
-    if supabase_result:
-        if progress_callback: progress_callback(1.0, "✓ Found in HonestWorld!")
-        cache_barcode(barcode, supabase_result)
-        return supabase_result
-    
-    if is_book_isbn(barcode):
-        result = lookup_open_library(barcode, progress_callback)
-        if result:
-            if progress_callback: progress_callback(1.0, "✓ Book found!")
-            cache_barcode(barcode, result)
-            return result
-    
-    result = lookup_open_food_facts(barcode, progress_callback)
-    if result:
-        if progress_callback: progress_callback(1.0, "✓ Found!")
-        cache_barcode(barcode, result)
-        return result
-    
-    result = lookup_open_beauty_facts(barcode, progress_callback)
-    if result:
-        if progress_callback: progress_callback(1.0, "✓ Found!")
-        cache_barcode(barcode, result)
-        return result
-    
-    result = lookup_upc_itemdb(barcode, progress_callback)
-    if result:
-        if progress_callback: progress_callback(1.0, "✓ Found!")
-        cache_barcode(barcode, result)
-        return result
-    
+    # Fire every remaining provider at once, then take answers in priority order: the first
+    # hit wins as soon as every provider ranked above it has answered "not found".
+    known_misses = get_barcode_misses(barcode)
+    executor = get_lookup_executor()
+    pending = [(name, executor.submit(lookup, barcode), pct, msg) for name, lookup, pct, msg in barcode_providers(barcode) if name not in known_misses]
+    misses = []
+    try:
+        for name, future, pct, msg in pending:
+            if progress_callback and not future.done(): progress_callback(pct, msg)
+            try:
+                result = future.result()
+            except Exception as e:
+                # Errors and timeouts are not cached: the product may well exist
+                print(f"Barcode provider {name} error: {e}")
+                continue
+            if result:
+                if progress_callback: progress_callback(1.0, BARCODE_FOUND_MESSAGES.get(name, "✓ Found!"))
+                cache_barcode(barcode, result)
+                record_barcode_misses(barcode, misses)
+                return result
+            misses.append(name)
+    finally:
+        for _, future, _, _ in pending: future.cancel()
+    
+    record_barcode_misses(barcode, misses)
     if progress_callback: progress_callback(1.0, "❌ Not found")
     return {'found': False, 'barcode': barcode, 'reason': 'not_in_database'}
 
 def preprocess_barcode_image(image):
     try:
-        gray = image.convert('L')
+        gray = image if image.mode == 'L' else image.convert('L')
         enhancer = ImageEnhance.Contrast(gray)
         return enhancer.enhance(2.5).filter(ImageFilter.SHARPEN)
     except: return image
 
+@st.cache_resource
+def get_decode_executor():
+    return ThreadPoolExecutor(max_workers=BARCODE_DECODE_WORKERS, thread_name_prefix='hw-decode')
+
+def decode_first(attempts):
+    """Run decode attempts on the shared pool; the earliest attempt in the given order that
+    succeeds wins, so the result does not depend on thread timing. Once an attempt succeeds,
+    later ones that have not started are skipped."""
+    won, lock = [len(attempts)], threading.Lock()
+    def run(i, attempt):
+        if i > won[0]: return None
+        result = attempt()
+        if result:
+            with lock: won[0] = min(won[0], i)
+        return result
+    futures = [get_decode_executor().submit(run, i, a) for i, a in enumerate(attempts)]
+    try:
+        for future in futures:
+            try: result = future.result()
+            except: continue
+            if result: return result
+    finally:
+        won[0] = -1
+        for future in futures: future.cancel()
+    return None
+
+def barcode_pyramid(data):
+    """Grayscale levels halving from BARCODE_PYRAMID_MAX_EDGE down to BARCODE_PYRAMID_MIN_EDGE,
+    coarsest first, as callables that decode their level on first use."""
+    with Image.open(BytesIO(data)) as img: w, h = img.size
+    scale = min(1.0, BARCODE_PYRAMID_MAX_EDGE / max(w, h))
+    sizes = [(max(1, round(w * scale)), max(1, round(h * scale)))]
+    while max(sizes[-1]) // 2 >= BARCODE_PYRAMID_MIN_EDGE: sizes.append((sizes[-1][0] // 2, sizes[-1][1] // 2))
+    def level(size):
+        lock, built = threading.Lock(), []
+        def get():
+            with lock:
+                if not built:
+                    img = Image.open(BytesIO(data))
+                    img.draft('L', size)  # JPEGs decode straight to grayscale at the smallest DCT scale covering the level
+                    img = img.convert('L')
+                    built.append(img if img.size == size else img.resize(size, Image.BOX))
+                return built[0]
+        return get
+    return [level(size) for size in sizes[::-1]]
+
 def try_decode_barcode_pyzbar(image_file):
+    """Full-frame pyzbar pass over a pyramid, as-is then contrast-enhanced per level.
+    
+    Rotated copies are not tried: zbar scans rows and columns in both directions already.
+    A level is only decoded when its first attempt runs, so a hit on a coarse level never pays
+    for the fine ones. A plain attempt copies its level once into zbar's buffer and an enhanced
+    one allocates at most three buffers the size of its level.
+    """
     try:
         from pyzbar import pyzbar
         image_file.seek(0)
-        img = Image.open(image_file)
-        for proc_img in [img, preprocess_barcode_image(img), img.convert('L'), img.rotate(90, expand=True), img.rotate(270, expand=True), img.rotate(180)]:
+        levels = barcode_pyramid(image_file.read())
+    except: return None
+    def plain(level): return lambda: next((b.data.decode('utf-8') for b in pyzbar.decode(level())), None)
+    def enhanced(level): return lambda: next((b.data.decode('utf-8') for b in pyzbar.decode(preprocess_barcode_image(level()))), None)
+    return decode_first([a for level in levels for a in (plain(level), enhanced(level))])
+
+def barcode_checksum_ok(code):
+    """GS1 mod-10 check for EAN-13, EAN-8, UPC-A, GTIN-14 and (expanded) UPC-E."""
+    if not code or not code.isdigit() or len(code) not in (8, 12, 13, 14): return False
+    def gs1(digits): return (sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(reversed(digits))) % 10) == 0
+    if gs1(code): return True
+    if len(code) == 8 and code[0] in '01':
+        n, d, c = code[0], code[1:7], code[7]
+        body = {'0': d[:2] + '00000' + d[2:5], '1': d[:2] + '10000' + d[2:5], '2': d[:2] + '20000' + d[2:5],
+                '3': d[:3] + '00000' + d[3:5], '4': d[:4] + '00000' + d[4]}.get(d[5], d[:5] + '0000' + d[5])
+        return gs1(n + body + c)
+    return False
+
+@st.cache_resource
+def get_barcode_detector():
+    try: return cv2.barcode.BarcodeDetector()
+    except: return None
+
+def _order_quad(pts):
+    """Corners clockwise from top-left, rotated so the first edge is the long side."""
+    pts = np.asarray(pts, dtype=np.float32).reshape(4, 2)
+    c = pts.mean(axis=0)
+    pts = pts[np.argsort(np.arctan2(pts[:, 1] - c[1], pts[:, 0] - c[0]))]
+    pts = np.roll(pts, -int(np.argmin(pts.sum(axis=1))), axis=0)
+    if np.linalg.norm(pts[1] - pts[0]) < np.linalg.norm(pts[2] - pts[1]): pts = np.roll(pts, -1, axis=0)
+    return pts
+
+def locate_barcode_regions(gray):
+    """Candidate barcode quads in full-resolution coordinates, most likely first.
+    
+    Locates on a copy scaled to BARCODE_DETECT_EDGE: cv2.barcode's detector first, then
+    the classic gradient/morphology search (strong gradient across the bars, weak along).
+    """
+    h, w = gray.shape
+    scale = min(1.0, BARCODE_DETECT_EDGE / max(h, w))
+    small = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    quads = []
+    detector = get_barcode_detector()
+    if detector is not None:
+        try:
+            ok, points = detector.detect(small)
+            if ok and points is not None: quads += [q for q in points.reshape(-1, 4, 2)]
+        except: pass
+    gx = cv2.Sobel(small, cv2.CV_32F, 1, 0, ksize=-1)
+    gy = cv2.Sobel(small, cv2.CV_32F, 0, 1, ksize=-1)
+    k = max(3, int(min(small.shape) / 60)) | 1
+    found = []
+    for grad, kernel in ((cv2.subtract(np.abs(gx), np.abs(gy)), (k * 3, k)), (cv2.subtract(np.abs(gy), np.abs(gx)), (k, k * 3))):
+        grad = cv2.convertScaleAbs(cv2.blur(grad, (9, 9)))
+        _, bw = cv2.threshold(grad, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        bw = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, kernel))
+        bw = cv2.dilate(cv2.erode(bw, None, iterations=4), None, iterations=4)
+        contours, _ = cv2.findContours(bw, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for cnt in contours:
+            area = cv2.contourArea(cnt)
+            if area > small.size * 0.002: found.append((area, cv2.boxPoints(cv2.minAreaRect(cnt))))
+    quads += [q for _, q in sorted(found, key=lambda f: -f[0])]
+    return [_order_quad(q) / scale for q in quads[:BARCODE_MAX_REGIONS]]
+
+def crop_barcode_roi(gray, quad, margin=0.12):
+    """Deskew a located quad into an upright strip with vertical bars, scaled so the
+    run across the bars is about BARCODE_ROI_WIDTH pixels."""
+    c = quad.mean(axis=0)
+    quad = c + (quad - c) * (1 + 2 * margin)
+    length = max(np.linalg.norm(quad[1] - quad[0]), np.linalg.norm(quad[2] - quad[3]))
+    height = max(np.linalg.norm(quad[3] - quad[0]), np.linalg.norm(quad[2] - quad[1]))
+    # Never warp more pixels than the final strip needs, whichever way the bars turn out to run
+    scale = min(1.0, 2 * BARCODE_ROI_WIDTH / max(length, 1))
+    x0, y0 = np.floor(np.maximum(quad.min(axis=0), 0)).astype(int)
+    x1, y1 = np.ceil(np.minimum(quad.max(axis=0), [gray.shape[1], gray.shape[0]])).astype(int)
+    if x1 - x0 < 8 or y1 - y0 < 8: return None
+    crop = gray[y0:y1, x0:x1]
+    if scale < 1: crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    src = ((quad - [x0, y0]) * (crop.shape[1] / (x1 - x0), crop.shape[0] / (y1 - y0))).astype(np.float32)
+    out_w, out_h = max(int(length * scale), 16), max(int(height * scale), 16)
+    dst = np.float32([[0, 0], [out_w, 0], [out_w, out_h], [0, out_h]])
+    roi = cv2.warpPerspective(crop, cv2.getPerspectiveTransform(src, dst), (out_w, out_h), borderMode=cv2.BORDER_REPLICATE)
+    gx, gy = np.abs(cv2.Sobel(roi, cv2.CV_32F, 1, 0)).sum(), np.abs(cv2.Sobel(roi, cv2.CV_32F, 0, 1)).sum()
+    if gy > gx: roi = cv2.rotate(roi, cv2.ROTATE_90_CLOCKWISE)
+    fit = min(BARCODE_ROI_MAX_UPSCALE, BARCODE_ROI_WIDTH / roi.shape[1])
+    if abs(fit - 1) > 0.1: roi = cv2.resize(roi, None, fx=fit, fy=fit, interpolation=cv2.INTER_AREA if fit < 1 else cv2.INTER_CUBIC)
+    return roi
+
+def _roi_variants(roi):
+    yield roi
+    yield cv2.createCLAHE(clipLimit=2.0, tileGridSize=(1, 8)).apply(roi)
+    yield cv2.resize(roi, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)  # halves blur in pixels
+
+def _decode_roi(roi, zbar):
+    """First checksum-valid read from the ROI variants, plus every read seen."""
+    reads, detector = [], get_barcode_detector()
+    for variant in _roi_variants(roi):
+        if zbar is not None:
+            try: reads += [b.data.decode('utf-8') for b in zbar.decode(variant)]
+            except: pass
+        if detector is not None and not reads:
             try:
-                barcodes = pyzbar.decode(proc_img)
-                if barcodes: return barcodes[0].data.decode('utf-8')
-            except: continue
-    except: pass
-    return None
+                text, _, _ = detector.detectAndDecode(variant)
+                if text: reads.append(text)
+            except: pass
+        for read in reads:
+            if barcode_checksum_ok(read): return read, reads
+    return None, reads
+
+def decode_barcode_image(image_file):
+    """Locate, deskew and decode barcodes in a photo; returns the code or None.
+    
+    Only the located regions are decoded, in parallel on the decode pool, and the first
+    checksum-valid read wins. A retail-length numeric read that fails its checksum is a
+    misread and is dropped; other symbologies are returned as read. Frames where no region
+    decodes (or nothing is located) go through the full-frame pyzbar pass.
+    """
+    if cv2 is None: return try_decode_barcode_pyzbar(image_file)
+    try: from pyzbar import pyzbar as zbar
+    except: zbar = None
+    try:
+        image_file.seek(0)
+        gray = cv2.imdecode(np.frombuffer(image_file.read(), np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            image_file.seek(0)
+            gray = np.asarray(Image.open(image_file).convert('L'))
+        quads, others = locate_barcode_regions(gray), []
+        def region(quad):
+            def attempt():
+                roi = crop_barcode_roi(gray, quad)
+                if roi is None: return None
+                read, reads = _decode_roi(roi, zbar)
+                others.extend(r for r in reads if not (r.isdigit() and len(r) in (8, 12, 13, 14)))
+                return read
+            return attempt
+        read = decode_first([region(q) for q in quads])
+        read = read or next(iter(others), None)
+        if read: return read
+    except Exception as e: print(f"Barcode engine error: {e}")
+    read = try_decode_barcode_pyzbar(image_file)
+    if read and read.isdigit() and len(read) in (8, 12, 13, 14) and not barcode_checksum_ok(read): return None
+    return read
 
 def ai_read_barcode(image_file):
     if not GEMINI_API_KEY: return None
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel("gemini-2.0-flash-exp")
-        image_file.seek(0)
-        img = Image.open(image_file)
+        model = get_gemini_model(GEMINI_MODEL)
+        img = prepare_gemini_image(image_file)
         resp = model.generate_content(["Look at this image and find the BARCODE. Read the numeric digits printed BELOW the barcode lines. Return ONLY the digits with NO spaces. If you cannot read it, return: NONE", img])
         text = resp.text.strip().upper()
         if 'NONE' in text or 'CANNOT' in text: return None
@@ -1466,22 +2728,147 @@ OUTPUT (Valid JSON)
     "price_value": "poor/fair/good"
 }}"""
 
-def analyze_product(images, location, progress_callback, barcode_info=None, user_profiles=None, user_allergies=None, user_input_name=None, user_input_brand=None):
+# ═══════════════════════════════════════════════════════════════════════════════
+# AI ANALYSIS CACHE
+# ═══════════════════════════════════════════════════════════════════════════════
+# Results are keyed by what Gemini saw: the photo pixels or barcode, the prompt context, the
+# prompt/law-table version and the model. Notifications depend on the viewer and are never stored.
+ANALYSIS_PROMPT_REVISION = 1  # bump when the inline barcode prompt or result post-processing changes
+ANALYSIS_PROMPT_VERSION = hashlib.sha256(json.dumps([ANALYSIS_PROMPT_REVISION, ANALYSIS_PROMPT, INTEGRITY_LAWS], sort_keys=True, default=str).encode()).hexdigest()[:16]
+ANALYSIS_CACHE_TTL_DAYS = 30
+ANALYSIS_LRU_SIZE = 256
+ANALYSIS_CACHE_EVICT_INTERVAL = 3600
+
+@st.cache_resource
+def get_analysis_memory_cache():
+    return LRUCache(ANALYSIS_LRU_SIZE)
+
+def image_digest(image_file):
+    """sha256 of the decoded, upright pixels, so a re-save that only touches metadata still matches."""
+    image_file.seek(0)
+    img = ImageOps.exif_transpose(Image.open(image_file))
+    h = hashlib.sha256(f'{img.mode}:{img.size}'.encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def analysis_cache_key(kind, subject, context):
+    return hashlib.sha256(json.dumps([kind, subject, ANALYSIS_PROMPT_VERSION, GEMINI_MODEL, context], sort_keys=True, default=str).encode()).hexdigest()
+
+def get_cached_analysis(key):
+    memory = get_analysis_memory_cache()
+    hit = memory.get(key)
+    if hit: return hit
+    try:
+        r = db_query_one("SELECT result, CAST(strftime('%s', expires_at) AS INTEGER) - CAST(strftime('%s', 'now') AS INTEGER) FROM analysis_cache WHERE key = ? AND expires_at > CURRENT_TIMESTAMP", (key,))
+        if r:
+            with db_transaction() as c:
+                c.execute('UPDATE analysis_cache SET hits = hits + 1, last_accessed = CURRENT_TIMESTAMP WHERE key = ?', (key,))
+            entry = json.loads(r[0])
+            memory.put(key, entry, r[1])
+            memory.incr('db_hits')
+            return dict(entry)
+    except: pass
+    memory.incr('db_misses')
+    return None
+
+def cache_analysis(key, kind, subject, result):
+    entry = {k: v for k, v in result.items() if k != 'notifications'}
+    try:
+        with db_transaction() as c:
+            c.execute('''INSERT INTO analysis_cache (key, kind, subject, prompt_version, model, result, expires_at) VALUES (?,?,?,?,?,?,datetime('now', ?))
+                         ON CONFLICT(key) DO UPDATE SET result=excluded.result, created_at=CURRENT_TIMESTAMP, last_accessed=CURRENT_TIMESTAMP, expires_at=excluded.expires_at''',
+                      (key, kind, subject, ANALYSIS_PROMPT_VERSION, GEMINI_MODEL, json.dumps(entry, default=str), f'+{ANALYSIS_CACHE_TTL_DAYS} days'))
+        memory = get_analysis_memory_cache()
+        memory.put(key, entry, ANALYSIS_CACHE_TTL_DAYS * 86400)
+        memory.incr('stores')
+    except Exception as e: print(f"Analysis cache write error: {e}")
+
+def invalidate_analysis_cache(everything=False):
+    """Drop analyses made with another prompt/law-table version or model, or every analysis."""
+    with db_transaction() as c:
+        if everything: dropped = c.execute('DELETE FROM analysis_cache').rowcount
+        else: dropped = c.execute('DELETE FROM analysis_cache WHERE prompt_version != ? OR model != ?', (ANALYSIS_PROMPT_VERSION, GEMINI_MODEL)).rowcount
+    memory = get_analysis_memory_cache()
+    if everything: memory.clear()
+    memory.incr('invalidated', dropped)
+    return dropped
+
+def evict_analysis_cache():
+    dropped = invalidate_analysis_cache()
+    with db_transaction() as c:
+        expired = c.execute('DELETE FROM analysis_cache WHERE expires_at <= CURRENT_TIMESTAMP').rowcount
+    get_analysis_memory_cache().incr('db_expired', expired)
+    if dropped or expired: print(f"Analysis cache evicted {dropped + expired} rows: {analysis_cache_stats()}")
+
+def analysis_cache_stats():
+    """Memory-tier counters plus db_hits, db_misses, stores, invalidated, db_expired and the overall hit_rate."""
+    stats = get_analysis_memory_cache().snapshot()
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['hits'] + stats.get('db_hits', 0)) / lookups, 3) if lookups else None
+    return stats
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CONSENSUS FAST PATH
+# ═══════════════════════════════════════════════════════════════════════════════
+# A product whose independent analyses agree is served from verified_products without a
+# Gemini call; a sample of those serves re-run the model in the background to keep it honest.
+CONSENSUS_MIN_SCANS = 5
+CONSENSUS_MAX_STDDEV = 6.0  # score points
+CONSENSUS_REVALIDATE_RATE = 0.05
+CONSENSUS_VOLATILE_KEYS = ('notifications', 'from_cache', 'from_consensus', 'consensus_scans', 'consensus_stddev')
+
+@st.cache_resource
+def get_revalidation_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='hw-revalidate')
+
+def get_consensus_result(product_name, brand=""):
+    """The stored analysis at the consensus score, or None until the product has settled."""
+    try:
+        r = db_query_one('SELECT verified_score, scan_count, score_var, last_result FROM verified_products WHERE product_hash = ? AND scan_count >= ? AND score_var <= ? AND last_result IS NOT NULL',
+                         (get_product_hash(product_name, brand), CONSENSUS_MIN_SCANS, CONSENSUS_MAX_STDDEV ** 2))
+        if not r: return None
+        last = json.loads(r[3])
+        if last.pop('prompt_version', None) != ANALYSIS_PROMPT_VERSION: return None
+        score = min(r[0], 60) if last.get('value_discrepancy') else r[0]
+        return dict(last, score=score, verdict=get_verdict(score), from_consensus=True, consensus_scans=r[1], consensus_stddev=round(math.sqrt(r[2]), 1))
+    except: return None
+
+def revalidate_consensus(barcode_info, location):
+    """Re-run the model for a consensus-served product off the request path and fold it in."""
+    def run():
+        result = analyze_from_barcode_data(barcode_info, location, lambda pct, msg: None, fresh=True)
+        if result.get('readable', True) and result.get('score', 0) > 0: save_verified_score(result)
+    try: get_revalidation_executor().submit(run)
+    except Exception as e: print(f"Consensus revalidation error: {e}")
+
+def result_notifications(result, user_profiles, user_allergies):
+    ingredients = result.get('ingredients', [])
+    full_text = ' '.join(result.get('fine_print', []) + result.get('front_claims', []))
+    return check_profile_notifications(ingredients, full_text, user_profiles or [], user_allergies or [], result.get('product_category', 'CATEGORY_FOOD'))
+
+# Real progress while the answer streams in: (fraction, message) when a field completes
+ANALYSIS_STREAM_PROGRESS = {
+    'product_name': (0.4, "Product identified..."),
+    'chain_of_thought': (0.55, "Applying integrity laws..."),
+    'score': (0.65, "Scoring..."),
+    'violations': (0.75, "Checking violations..."),
+    'ingredients': (0.85, "Reading ingredients..."),
+}
+
+def stream_progress(progress_callback, on_partial=None, **overrides):
+    """on_field callback for stream_json_response: advances the bar and hands the fields so far to on_partial."""
+    def on_field(name, fields):
+        if name in ANALYSIS_STREAM_PROGRESS: progress_callback(*ANALYSIS_STREAM_PROGRESS[name])
+        if on_partial: on_partial(dict(fields, **overrides))
+    return on_field
+
+def analyze_product(images, location, progress_callback, barcode_info=None, user_profiles=None, user_allergies=None, user_input_name=None, user_input_brand=None, on_partial=None):
+    """Analyze product photos; on_partial(fields) receives the answer's fields as they stream in."""
     progress_callback(0.1, "Reading product...")
     
     if not GEMINI_API_KEY:
         return {"product_name": "API Key Missing", "score": 0, "verdict": "UNCLEAR", "readable": False, "violations": [], "main_issue": "Add GEMINI_API_KEY to secrets"}
     
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel("gemini-2.0-flash-exp", generation_config={"temperature": 0.1, "max_output_tokens": 8192})
-    
-    pil_images = []
-    for img in images:
-        img.seek(0)
-        pil_images.append(Image.open(img))
-    
-    progress_callback(0.3, "Analyzing with Value Gap detection...")
-    
     barcode_context = ""
     if barcode_info and barcode_info.get('found'):
         barcode_context = f"""
@@ -1499,30 +2886,35 @@ USER PROVIDED CONTEXT:
 The user has identified this product as '{user_input_name or "Unknown"}' by '{user_input_brand or "Unknown"}'.
 Use this to help identify the product if the image is blurry or hard to read."""
     
-    prompt = ANALYSIS_PROMPT.format(
-        location=f"{location.get('city', '')}, {location.get('country', '')}",
-        barcode_context=barcode_context + user_context
-    )
+    prompt_args = {'location': f"{location.get('city', '')}, {location.get('country', '')}", 'barcode_context': barcode_context + user_context}
+    try:
+        subject = ','.join(image_digest(img) for img in images)
+        cache_key = analysis_cache_key('image', subject, prompt_args)
+        cached = get_cached_analysis(cache_key)
+    except: cache_key, cached = None, None
+    if cached:
+        cached['from_cache'] = True
+        cached['notifications'] = result_notifications(cached, user_profiles, user_allergies)
+        progress_callback(1.0, "Complete!")
+        return cached
     
-    progress_callback(0.5, "Applying integrity laws...")
+    model = get_gemini_model(GEMINI_MODEL, GEMINI_ANALYSIS_CONFIG)
+    
+    image_parts = [prepare_gemini_image(img) for img in images]
+    
+    progress_callback(0.3, "Analyzing with Value Gap detection...")
+    
+    prompt = ANALYSIS_PROMPT.format(**prompt_args)
     
     try:
-        response = model.generate_content([prompt] + pil_images)
-        text = response.text.strip()
+        result, complete = stream_json_response(model, [prompt] + image_parts, stream_progress(progress_callback, on_partial))
         
-        result = None
-        json_match = re.search(r'\{[\s\S]*\}', text)
-        if json_match:
-            try: result = json.loads(json_match.group(0))
-            except:
-                clean_text = text.replace('```json', '').replace('```', '').strip()
-                try: result = json.loads(clean_text)
-                except: pass
-        
-        if not result:
+        # A cut-off answer is still shown if it got as far as the score, but never cached or counted
+        if result and not complete: result['truncated'] = True
+        if not result or 'score' not in result:
             return {"product_name": "Parse Error", "score": 0, "verdict": "UNCLEAR", "readable": False, "violations": [], "main_issue": "Could not parse AI response"}
         
-        progress_callback(0.7, "Validating score...")
+        progress_callback(0.9, "Validating score...")
         
         score = result.get('score', 75)
         if isinstance(score, str):
@@ -1553,12 +2945,9 @@ Use this to help identify the product if the image is blurry or hard to read."""
             result['score'] = 0
             result['verdict'] = 'UNCLEAR'
         
-        product_category = result.get('product_category', 'CATEGORY_FOOD')
-        ingredients = result.get('ingredients', [])
-        full_text = ' '.join(result.get('fine_print', []) + result.get('front_claims', []))
-        
-        notifications = check_profile_notifications(ingredients, full_text, user_profiles or [], user_allergies or [], product_category)
-        result['notifications'] = notifications
+        # Unreadable photos are not cached so a retry still reaches the model
+        if cache_key and result.get('readable', True) and complete: cache_analysis(cache_key, 'image', subject, result)
+        result['notifications'] = result_notifications(result, user_profiles, user_allergies)
         
         progress_callback(1.0, "Complete!")
         return result
@@ -1566,8 +2955,11 @@ Use this to help identify the product if the image is blurry or hard to read."""
     except Exception as e:
         return {"product_name": "Error", "score": 0, "verdict": "UNCLEAR", "readable": False, "violations": [], "main_issue": f"Error: {str(e)[:100]}"}
 
-def analyze_from_barcode_data(barcode_info, location, progress_callback, user_profiles=None, user_allergies=None):
-    """Analyze product using barcode database information + product image vision"""
+def analyze_from_barcode_data(barcode_info, location, progress_callback, user_profiles=None, user_allergies=None, fresh=False, on_partial=None):
+    """Analyze product using barcode database information + product image vision.
+    
+    Served from the analysis cache or the product consensus when possible; fresh=True always asks the model.
+    on_partial(fields) receives the model's fields as they stream in."""
     if not GEMINI_API_KEY:
         return {"product_name": barcode_info.get('name', 'Unknown'), "score": 0, "verdict": "UNCLEAR", "readable": False, "violations": [], "main_issue": "Add GEMINI_API_KEY to secrets"}
     
@@ -1583,23 +2975,34 @@ def analyze_from_barcode_data(barcode_info, location, progress_callback, user_pr
     if barcode_info.get('is_book'):
         return {"product_name": product_name, "brand": brand, "product_category": "CATEGORY_BOOK", "product_type": "book", "readable": True, "score": 85, "verdict": "BUY", "violations": [], "bonuses": [], "ingredients": [], "main_issue": "N/A - This is a book", "positive": f"Published: {barcode_info.get('publish_date', 'Unknown')}", "notifications": [], "is_book": True, "health_grade": None}
     
+    barcode = barcode_info.get('barcode') or ''
+    cache_key = analysis_cache_key('barcode', barcode, [product_name, brand, ingredients_text, categories, nutrition, image_url, location.get('city', ''), location.get('country', '')])
+    cached = None if fresh else get_cached_analysis(cache_key)
+    if cached: cached['from_cache'] = True
+    elif not fresh:
+        cached = get_consensus_result(product_name, brand)
+        if cached and random.random() < CONSENSUS_REVALIDATE_RATE: revalidate_consensus(barcode_info, location)
+    if cached:
+        cached['notifications'] = result_notifications(cached, user_profiles, user_allergies)
+        progress_callback(1.0, "Complete!")
+        return cached
+    
     progress_callback(0.3, "Checking for product image...")
     
     # Try to download product image for marketing claim detection
     product_image = None
     if image_url:
         try:
-            img_response = requests.get(image_url, timeout=10)
+            img_response = http_get(image_url)
             if img_response.ok:
-                product_image = Image.open(BytesIO(img_response.content))
+                product_image = prepare_gemini_image(BytesIO(img_response.content))
                 progress_callback(0.4, "Product image loaded for vision analysis...")
         except:
             pass  # Continue without image if download fails
     
     progress_callback(0.5, "Analyzing with all 21 Integrity Laws...")
     
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel("gemini-2.0-flash-exp", generation_config={"temperature": 0.1, "max_output_tokens": 8192})
+    model = get_gemini_model(GEMINI_MODEL, GEMINI_ANALYSIS_CONFIG)
     
     # Enhanced prompt using ANALYSIS_PROMPT style
     prompt = f"""You are HonestWorld's Marketing Integrity Analyzer.
@@ -1644,22 +3047,12 @@ Location: {location.get('city', '')}, {location.get('country', '')}
 
 Return valid JSON with: product_name, brand, product_category, product_type, implied_promise, functional_expectation, actual_reality, value_discrepancy, value_discrepancy_reason, split_ingredients_detected, readable, score (0-100), violations (array with law, name, points, evidence), bonuses, ingredients, ingredients_flagged (with name, concern, source, severity), good_ingredients, main_issue, positive, front_claims, confidence, price_value"""
     
-    progress_callback(0.7, "Applying integrity laws...")
-    
     try:
         # Use image if available for vision analysis
-        if product_image:
-            response = model.generate_content([prompt, product_image])
-        else:
-            response = model.generate_content(prompt)
-        
-        text = response.text.strip()
-        
-        json_match = re.search(r'\{[\s\S]*\}', text)
-        if json_match:
-            result = json.loads(json_match.group(0))
-        else:
-            result = json.loads(text.replace('```json', '').replace('```', '').strip())
+        contents = [prompt, product_image] if product_image else prompt
+        result, complete = stream_json_response(model, contents, stream_progress(progress_callback, on_partial, product_name=product_name, brand=brand))
+        if not result or 'score' not in result: raise ValueError("Could not parse AI response")
+        if not complete: result['truncated'] = True
         
         score = result.get('score', 75)
         if isinstance(score, str):
@@ -1697,11 +3090,8 @@ Return valid JSON with: product_name, brand, product_category, product_type, imp
             result['health_grade'] = None
             result['health_grade_details'] = None
         
-        ingredients = result.get('ingredients', [])
-        full_text = ' '.join(result.get('fine_print', []) + result.get('front_claims', []))
-        
-        notifications = check_profile_notifications(ingredients, full_text, user_profiles or [], user_allergies or [], product_category)
-        result['notifications'] = notifications
+        if complete: cache_analysis(cache_key, 'barcode', barcode, result)
+        result['notifications'] = result_notifications(result, user_profiles, user_allergies)
         
         progress_callback(1.0, "Complete!")
         return result
@@ -1711,7 +3101,7 @@ Return valid JSON with: product_name, brand, product_category, product_type, imp
         health_grade = None
         if nutrition:
             health_grade, _ = calculate_health_grade(nutrition)
-        return {"product_name": product_name, "brand": brand, "score": 65, "verdict": "CAUTION", "readable": True, "main_issue": "Limited data - verify claims", "violations": [], "bonuses": [], "ingredients": [], "notifications": [], "confidence": "low", "health_grade": health_grade}
+        return {"product_name": product_name, "brand": brand, "score": 65, "verdict": "CAUTION", "readable": True, "main_issue": "Limited data - verify claims", "violations": [], "bonuses": [], "ingredients": [], "notifications": [], "confidence": "low", "health_grade": health_grade, "fallback": True}
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # IMPROVED SHARE IMAGES - NO DOWNLOAD MESSAGING
@@ -2011,6 +3401,11 @@ CSS = """
 def main():
     st.markdown(CSS, unsafe_allow_html=True)
     init_db()
+    start_background_worker('barcode-cache-evictor', BARCODE_CACHE_EVICT_INTERVAL, evict_barcode_cache)
+    start_background_worker('analysis-cache-evictor', ANALYSIS_CACHE_EVICT_INTERVAL, evict_analysis_cache)
+    warm_up_gemini()
+    start_background_worker('scan-log-flusher', SCAN_LOG_FLUSH_INTERVAL, flush_scan_log, get_scan_log_wakeup())
+    start_background_worker('global-scans-sync', GLOBAL_SCANS_SYNC_INTERVAL, sync_global_scans, get_global_scans_wakeup())
     user_id = get_user_id()
     
     for key in ['result', 'scan_id', 'admin', 'barcode_info', 'show_result', 'contribute_mode', 'contribute_barcode']:
@@ -2050,30 +3445,24 @@ def main():
         <div class='stat-box'><div class='stat-val'>{stats['best_streak']}</div><div class='stat-lbl'>Best Streak</div></div>
     </div>""", unsafe_allow_html=True)
     
-    tab_scan, tab_history, tab_map, tab_profile, tab_laws = st.tabs(["📷 Scan", "📋 History", "🗺️ World Map", "👤 Profile", "⚖️ Laws"])
-    
-    with tab_scan:
-        if st.session_state.contribute_mode:
-            render_contribute_interface(user_id)
-        elif st.session_state.result and st.session_state.show_result:
-            display_result(st.session_state.result, user_id)
-        else:
-            render_scan_interface(user_id)
-    
-    with tab_history:
-        render_history(user_id)
-    
-    with tab_map:
-        render_world_map()
-    
-    with tab_profile:
-        render_profile()
-    
-    with tab_laws:
-        render_laws()
+    # Only the selected tab is rendered, and each tab is a fragment, so its own widgets
+    # rerun just that tab instead of the whole page
+    tab = st.radio("Tab", list(TABS), horizontal=True, label_visibility="collapsed", key="nav_tab")
+    render_tab, needs_user = TABS[tab]
+    if needs_user: render_tab(user_id)
+    else: render_tab()
     
     st.markdown(f"<center style='color:#94a3b8;font-size:0.7rem;margin-top:1rem;'>🌍 HonestWorld v{VERSION}</center>", unsafe_allow_html=True)
 
+@st.fragment
+def render_scan_tab(user_id):
+    if st.session_state.contribute_mode:
+        render_contribute_interface(user_id)
+    elif st.session_state.result and st.session_state.show_result:
+        display_result(st.session_state.result, user_id)
+    else:
+        render_scan_interface(user_id)
+
 def render_scan_interface(user_id):
     input_method = st.radio("", ["📷 Camera", "📁 Upload", "📊 Barcode"], horizontal=True, label_visibility="collapsed")
     images = []
@@ -2099,19 +3488,27 @@ def render_scan_interface(user_id):
         barcode_img = st.camera_input("", label_visibility="collapsed", key="barcode_cam")
         
         if barcode_img:
-            with st.spinner("📖 Reading barcode..."):
-                barcode_num = try_decode_barcode_pyzbar(barcode_img)
-                if not barcode_num:
-                    barcode_num = ai_read_barcode(barcode_img)
+            # Decode and look up each distinct frame once; later reruns reuse the result.
+            # A contribution drops the entries for its barcode (see forget_barcode_reads).
+            digest = hashlib.sha256(barcode_img.getvalue()).hexdigest()
+            reads = st.session_state.setdefault('barcode_reads', {})
+            if digest not in reads:
+                with st.spinner("📖 Reading barcode..."):
+                    reads[digest] = {'barcode': decode_barcode_image(barcode_img) or ai_read_barcode(barcode_img)}
+                while len(reads) > BARCODE_READ_MEMO_SIZE: reads.pop(next(iter(reads)))
+            read = reads[digest]
+            barcode_num = read['barcode']
             
             if barcode_num:
                 st.info(f"📊 Barcode: **{barcode_num}**")
-                progress_container = st.empty()
-                def update_progress(pct, msg):
-                    progress_container.markdown(f"<div class='progress-box'><div style='font-size:1.1rem;font-weight:600;'>{msg}</div><div class='progress-bar'><div class='progress-fill' style='width:{pct*100}%'></div></div></div>", unsafe_allow_html=True)
-                
-                barcode_info = waterfall_barcode_search(barcode_num, update_progress)
-                progress_container.empty()
+                if 'info' not in read:
+                    progress_container = st.empty()
+                    def update_progress(pct, msg):
+                        progress_container.markdown(f"<div class='progress-box'><div style='font-size:1.1rem;font-weight:600;'>{msg}</div><div class='progress-bar'><div class='progress-fill' style='width:{pct*100}%'></div></div></div>", unsafe_allow_html=True)
+                    
+                    read['info'] = waterfall_barcode_search(barcode_num, update_progress)
+                    progress_container.empty()
+                barcode_info = read['info']
                 
                 if barcode_info.get('found'):
                     st.success(f"✅ **{barcode_info.get('name', '')}**")
@@ -2122,7 +3519,7 @@ def render_scan_interface(user_id):
                         with st.expander("📋 Ingredients"):
                             st.write(barcode_info.get('ingredients', '')[:500])
                     
-                    st.session_state.barcode_info = barcode_info
+                    st.session_state.barcode_info = dict(barcode_info, barcode=barcode_num)
                     st.session_state.barcode_only = True
                     images = [barcode_img]
                 else:
@@ -2142,16 +3539,21 @@ def render_scan_interface(user_id):
                 icon = icons[min(int(pct * 4), 3)]
                 progress_ph.markdown(f"<div class='progress-box'><div style='font-size:2rem;'>{icon}</div><div style='font-weight:600;'>{msg}</div><div class='progress-bar'><div class='progress-fill' style='width:{pct*100}%'></div></div></div>", unsafe_allow_html=True)
             
+            preview_ph = st.empty()
+            def show_partial(fields):
+                preview_ph.markdown(partial_result_html(fields), unsafe_allow_html=True)
+            
             user_profiles, user_allergies = get_profiles(), get_allergies()
             bi = st.session_state.get('barcode_info')
             
             if st.session_state.get('barcode_only') and bi and bi.get('found'):
-                result = analyze_from_barcode_data(bi, st.session_state.loc, update_prog, user_profiles, user_allergies)
+                result = analyze_from_barcode_data(bi, st.session_state.loc, update_prog, user_profiles, user_allergies, on_partial=show_partial)
                 st.session_state.barcode_only = False
             else:
-                result = analyze_product(images, st.session_state.loc, update_prog, bi, user_profiles, user_allergies)
+                result = analyze_product(images, st.session_state.loc, update_prog, bi, user_profiles, user_allergies, on_partial=show_partial)
             
             progress_ph.empty()
+            preview_ph.empty()
             
             if result.get('readable', True) and result.get('score', 0) > 0:
                 thumb = None
@@ -2165,8 +3567,8 @@ def render_scan_interface(user_id):
                         thumb = buf.getvalue()
                 except: pass
                 
-                scan_id = save_scan(result, user_id, thumb, st.session_state.loc)
-                cloud_log_scan(result, st.session_state.loc, user_id)
+                scan_id = commit_scan(result, user_id, thumb, st.session_state.loc)
+                cloud_log_scan(result, st.session_state.loc, user_id, scan_id)
                 
                 st.session_state.result = result
                 st.session_state.scan_id = scan_id
@@ -2209,6 +3611,9 @@ def render_contribute_interface(user_id):
             progress_ph = st.empty()
             def update_prog(pct, msg):
                 progress_ph.markdown(f"<div class='progress-box'><div style='font-weight:600;'>{msg}</div><div class='progress-bar'><div class='progress-fill' style='width:{pct*100}%'></div></div></div>", unsafe_allow_html=True)
+            preview_ph = st.empty()
+            def show_partial(fields):
+                preview_ph.markdown(partial_result_html(fields), unsafe_allow_html=True)
             
             # Pass user-provided name and brand to help AI identify blurry images
             result = analyze_product(
@@ -2219,12 +3624,14 @@ def render_contribute_interface(user_id):
                 get_profiles(), 
                 get_allergies(),
                 user_input_name=product_name if product_name else None,
-                user_input_brand=brand if brand else None
+                user_input_brand=brand if brand else None,
+                on_partial=show_partial
             )
             # Still override with user input if provided (in case AI got it wrong)
             if product_name: result['product_name'] = product_name
             if brand: result['brand'] = brand
             progress_ph.empty()
+            preview_ph.empty()
             
             if result.get('readable', True) and result.get('score', 0) > 0:
                 product_data = {
@@ -2237,7 +3644,6 @@ def render_contribute_interface(user_id):
                     'image_url': ''   # Could be added later if we support image uploads
                 }
                 supabase_save_product(barcode, product_data, user_id)
-                cache_barcode(barcode, product_data)
                 
                 thumb = None
                 try:
@@ -2249,8 +3655,9 @@ def render_contribute_interface(user_id):
                     thumb = buf.getvalue()
                 except: pass
                 
-                scan_id = save_scan(result, user_id, thumb, st.session_state.loc)
-                cloud_log_scan(result, st.session_state.loc, user_id)
+                scan_id = commit_scan(result, user_id, thumb, st.session_state.loc, barcode=barcode, barcode_data=product_data)
+                forget_barcode_reads(barcode)
+                cloud_log_scan(result, st.session_state.loc, user_id, scan_id)
                 
                 st.session_state.result = result
                 st.session_state.scan_id = scan_id
@@ -2262,6 +3669,35 @@ def render_contribute_interface(user_id):
             else:
                 st.error("❌ Could not analyze. Try clearer photos.")
 
+def verdict_card_html(score, verdict, note=""):
+    display = get_verdict_display(verdict)
+    note_html = f"<div style='font-size:0.8rem;opacity:0.8;'>{note}</div>" if note else ""
+    return f"""<div class='verdict-card verdict-{verdict.lower()}'>
+        <div class='verdict-icon'>{display['icon']}</div>
+        <div class='verdict-text'>{display['text']}</div>
+        <div class='verdict-score'>{score}<span style='font-size:1.5rem;'>/100</span></div>{note_html}
+    </div>"""
+
+def partial_result_html(fields):
+    """Preview of a streaming analysis: whatever of name, score and main issue has arrived.
+    
+    The score is provisional until the violations are in and display_result takes over."""
+    parts = []
+    score = fields.get('score')
+    if fields.get('readable', True) and isinstance(score, (int, float)):
+        score = max(0, min(100, int(score)))
+        if fields.get('value_discrepancy'): score = min(score, 60)
+        parts.append(verdict_card_html(score, get_verdict(score), "Preliminary · still analyzing..."))
+    if fields.get('product_name'):
+        parts.append(f"<h3>{html.escape(str(fields['product_name']))}</h3>")
+        if fields.get('brand'): parts.append(f"<p><em>by {html.escape(str(fields['brand']))}</em></p>")
+    cat_info = PRODUCT_CATEGORIES.get(fields.get('product_category'))
+    if cat_info: parts.append(f"<span class='cat-badge'>{cat_info.get('icon', '📦')} {cat_info.get('name', 'Product')}</span>")
+    if fields.get('implied_promise'):
+        parts.append(f"<div class='implied-promise'>🎭 <strong>Marketing Promise:</strong> \"{html.escape(str(fields['implied_promise']))}\"</div>")
+    if fields.get('main_issue'): parts.append(f"<p>⚠️ {html.escape(str(fields['main_issue']))}</p>")
+    return ''.join(parts)
+
 def display_result(result, user_id):
     score = result.get('score', 0)
     verdict = result.get('verdict', 'UNCLEAR')
@@ -2270,7 +3706,6 @@ def display_result(result, user_id):
     implied_promise = result.get('implied_promise', '')
     value_discrepancy = result.get('value_discrepancy', False)
     health_grade = result.get('health_grade')
-    display = get_verdict_display(verdict)
     
     # VALUE DISCREPANCY ALERT - TOP OF SCREEN (Primary Alert)
     if value_discrepancy:
@@ -2282,11 +3717,7 @@ def display_result(result, user_id):
         </div>""", unsafe_allow_html=True)
     
     # Main verdict card
-    st.markdown(f"""<div class='verdict-card verdict-{verdict.lower()}'>
-        <div class='verdict-icon'>{display['icon']}</div>
-        <div class='verdict-text'>{display['text']}</div>
-        <div class='verdict-score'>{score}<span style='font-size:1.5rem;'>/100</span></div>
-    </div>""", unsafe_allow_html=True)
+    st.markdown(verdict_card_html(score, verdict), unsafe_allow_html=True)
     
     # Product info and health grade
     col1, col2 = st.columns([3, 1])
@@ -2312,6 +3743,8 @@ def display_result(result, user_id):
     
     cat_info = PRODUCT_CATEGORIES.get(product_category, {})
     st.markdown(f"<span class='cat-badge'>{cat_info.get('icon', '📦')} {cat_info.get('name', 'Product')}</span>", unsafe_allow_html=True)
+    if result.get('from_consensus'):
+        st.markdown(f"<span class='cat-badge'>🤝 Community consensus · {result.get('consensus_scans', 0)} analyses</span>", unsafe_allow_html=True)
     
     # Cosmetic-specific highlights (fragrance-free, paraben-free, etc.)
     if product_category == 'CATEGORY_COSMETIC':
@@ -2443,9 +3876,11 @@ def display_result(result, user_id):
         st.session_state.show_result = False
         st.rerun()
 
+@st.fragment
 def render_history(user_id):
-    history = get_history(user_id, 30)
-    if not history:
+    cursors = st.session_state.setdefault('history_cursors', [None])
+    history = get_history(user_id, HISTORY_PAGE_SIZE, cursors[-1])
+    if not history and len(cursors) == 1:
         st.info("📋 No scans yet! Start scanning products.")
     else:
         for item in history:
@@ -2459,10 +3894,16 @@ def render_history(user_id):
                 st.markdown(f"**{fav}{item['product'][:28]}**")
                 st.caption(f"{item['brand'][:16] if item['brand'] else ''} • {item['ts'][:10]}")
             with col3:
-                if st.button("⭐" if not item['favorite'] else "★", key=f"fav_{item['db_id']}"):
-                    toggle_favorite(item['db_id'], item['favorite'])
-                    st.rerun()
+                # Callbacks run before the fragment reruns, so no full-page rerun is needed
+                st.button("⭐" if not item['favorite'] else "★", key=f"fav_{item['db_id']}", on_click=toggle_favorite, args=(item['db_id'], item['favorite']))
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if len(cursors) > 1: st.button("← Newer", use_container_width=True, on_click=cursors.pop)
+        with col2:
+            if len(history) == HISTORY_PAGE_SIZE: st.button("Older →", use_container_width=True, on_click=cursors.append, args=(history[-1]['cursor'],))
 
+@st.fragment
 def render_world_map():
     st.markdown("### 🗺️ Global Scan Activity")
     st.caption("Real-time view of HonestWorld scans around the world")
@@ -2471,41 +3912,19 @@ def render_world_map():
     center_lat = loc.get('lat', -27.5) or -27.5
     center_lon = loc.get('lon', 153.0) or 153.0
     
-    # Get local and global data
-    local_data = get_map_data(500)
-    global_data = supabase_get_global_scans(1000)
-    
-    # Combine all points
-    all_points = []
-    seen_coords = set()  # Avoid duplicates
-    
-    for d in local_data:
-        if d.get('lat') and d.get('lon'):
-            coord_key = f"{round(d['lat'], 3)},{round(d['lon'], 3)}"
-            if coord_key not in seen_coords:
-                seen_coords.add(coord_key)
-                all_points.append({'lat': d['lat'], 'lon': d['lon'], 'score': d.get('score', 70), 'verdict': d.get('verdict', 'CAUTION'), 'product': d.get('product', ''), 'city': d.get('city', '')})
-    
-    for d in global_data:
-        if d.get('lat') and d.get('lon'):
-            coord_key = f"{round(d['lat'], 3)},{round(d['lon'], 3)}"
-            if coord_key not in seen_coords:
-                seen_coords.add(coord_key)
-                all_points.append({'lat': d['lat'], 'lon': d['lon'], 'score': d.get('score', 70), 'verdict': d.get('verdict', 'CAUTION'), 'product': d.get('product_name', ''), 'city': d.get('city', '')})
-    
-    # Stats display
-    total_scans = len(local_data) + len(global_data)
-    unique_cities = len(set(p.get('city', '') for p in all_points if p.get('city')))
+    clusters = get_map_clusters()
+    total_scans = clusters['local'] + clusters['global']
     
     # Stats row ABOVE map
     st.markdown(f"""<div class='stat-row'>
-        <div class='stat-box'><div class='stat-val'>{len(local_data)}</div><div class='stat-lbl'>Your Scans</div></div>
-        <div class='stat-box'><div class='stat-val'>{len(global_data)}</div><div class='stat-lbl'>Global Scans</div></div>
-        <div class='stat-box'><div class='stat-val'>{unique_cities}</div><div class='stat-lbl'>Cities Active</div></div>
+        <div class='stat-box'><div class='stat-val'>{clusters['local']}</div><div class='stat-lbl'>Your Scans</div></div>
+        <div class='stat-box'><div class='stat-val'>{clusters['global']}</div><div class='stat-lbl'>Global Scans</div></div>
+        <div class='stat-box'><div class='stat-val'>{clusters['cities']}</div><div class='stat-lbl'>Cities Active</div></div>
     </div>""", unsafe_allow_html=True)
     
     # Determine zoom level based on data
-    zoom_level = 3 if len(all_points) > 10 else 10
+    zoom_level = 3 if total_scans > 10 else 10
+    user_city = json.dumps(html.escape(loc.get('city', 'Your Location') or 'Your Location'))
     
     map_html = f"""
     <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
@@ -2514,7 +3933,7 @@ def render_world_map():
     <div id="map" style="height: 400px; width: 100%; border-radius: 16px; border: 2px solid #e2e8f0;"></div>
     <script>
         setTimeout(function() {{
-            var map = L.map('map').setView([{center_lat}, {center_lon}], {zoom_level});
+            var map = L.map('map', {{preferCanvas: true}}).setView([{center_lat}, {center_lon}], {zoom_level});
             L.tileLayer('https://{{s}}.basemaps.cartocdn.com/light_all/{{z}}/{{x}}/{{y}}{{r}}.png', {{
                 attribution: '© OpenStreetMap © CARTO',
                 maxZoom: 19
@@ -2526,36 +3945,43 @@ def render_world_map():
                 html: '<div style="background:#3b82f6;width:20px;height:20px;border-radius:50%;border:3px solid white;box-shadow:0 2px 10px rgba(0,0,0,0.3);"></div>',
                 iconSize: [20, 20]
             }});
-            L.marker([{center_lat}, {center_lon}], {{icon: userIcon}}).addTo(map).bindPopup("<b>📍 You are here</b><br>{loc.get('city', 'Your Location')}");
-            """
-    
-    # Add heatmap if we have points
-    if all_points:
-        heat_points = [f"[{p['lat']}, {p['lon']}, {0.8 if p.get('verdict') == 'HIGH_CAUTION' else 0.5}]" for p in all_points[:500] if p.get('lat') and p.get('lon')]
-        map_html += f"""
-            var heatData = [{','.join(heat_points)}];
-            if (heatData.length > 0) {{ 
-                L.heatLayer(heatData, {{radius: 25, blur: 15, maxZoom: 10, gradient: {{0.2: '#22c55e', 0.4: '#84cc16', 0.6: '#f59e0b', 0.8: '#ef4444', 1: '#dc2626'}}}}).addTo(map); 
+            L.marker([{center_lat}, {center_lon}], {{icon: userIcon}}).addTo(map).bindPopup("<b>📍 You are here</b><br>" + {user_city});
+            
+            // Cells: [lat, lon, count, mean score, high caution, caution, city, product], one list per zoom band
+            var bands = {json.dumps(clusters['bands'], separators=(',', ':'))};
+            // Heat cells: [lat, lon, weight], one list per zoom band, precomputed server-side
+            var heatBands = {json.dumps(get_density_bands(), separators=(',', ':'))};
+            var heat = L.heatLayer([], {{radius: 25, blur: 15, maxZoom: 10, gradient: {{0.2: '#22c55e', 0.4: '#84cc16', 0.6: '#f59e0b', 0.8: '#ef4444', 1: '#dc2626'}}}}).addTo(map);
+            var markers = L.layerGroup().addTo(map);
+            function esc(s) {{ return String(s).replace(/[&<>"']/g, function(ch) {{ return '&#' + ch.charCodeAt(0) + ';'; }}); }}
+            function cellsFor(bands, zoom) {{
+                var cells = bands[0][1];
+                bands.forEach(function(b) {{ if (zoom >= b[0]) cells = b[1]; }});
+                return cells;
             }}
-        """
-        
-        # Add individual markers for recent scans (max 30)
-        for p in all_points[:30]:
-            if p.get('lat') and p.get('lon'):
-                color = '#ef4444' if p.get('verdict') == 'HIGH_CAUTION' else '#f59e0b' if p.get('verdict') == 'CAUTION' else '#22c55e'
-                product_safe = (p.get('product', 'Product')[:25] or 'Product').replace("'", "\\'").replace('"', '\\"').replace('\n', ' ')
-                p_score = p.get('score', '?')
-                city_safe = (p.get('city', '')[:20] or '').replace("'", "\\'")
-                map_html += f"""
-                    L.circleMarker([{p['lat']}, {p['lon']}], {{
-                        radius: 8, 
-                        fillColor: '{color}', 
-                        color: '#fff', 
-                        weight: 2, 
+            function draw() {{
+                var cells = cellsFor(bands, map.getZoom());
+                heat.setLatLngs(cellsFor(heatBands, map.getZoom()));
+                markers.clearLayers();
+                cells.forEach(function(c) {{
+                    var safe = c[2] - c[4] - c[5];
+                    var color = c[4] >= c[5] && c[4] >= safe ? '#ef4444' : c[5] >= safe ? '#f59e0b' : '#22c55e';
+                    var title = c[2] == 1 ? esc(c[7] || 'Product').slice(0, 25) : c[2] + ' scans';
+                    var mix = c[2] == 1 ? '' : '<br><small>🔴 ' + c[4] + ' · 🟡 ' + c[5] + ' · 🟢 ' + safe + '</small>';
+                    L.circleMarker([c[0], c[1]], {{
+                        radius: Math.min(8 + 3 * Math.log2(c[2]), 24),
+                        fillColor: color,
+                        color: '#fff',
+                        weight: 2,
                         fillOpacity: 0.9
-                    }}).addTo(map).bindPopup('<div style="text-align:center;"><b>{product_safe}</b><br><span style="font-size:1.2em;color:{color};">{p_score}/100</span><br><small>{city_safe}</small></div>');
-                """
-    else:
+                    }}).addTo(markers).bindPopup('<div style="text-align:center;"><b>' + title + '</b><br><span style="font-size:1.2em;color:' + color + ';">' + c[3] + '/100</span>' + mix + '<br><small>' + esc(c[6]).slice(0, 20) + '</small></div>');
+                }});
+            }}
+            draw();
+            map.on('zoomend', draw);
+            """
+    
+    if not total_scans:
         # No data yet - show message
         map_html += """
             L.popup()
@@ -2565,20 +3991,29 @@ def render_world_map():
         """.replace('{center_lat}', str(center_lat)).replace('{center_lon}', str(center_lon))
     
     map_html += """
-        }}, 100);
+        }, 100);
     </script>
     """
     
     st.components.v1.html(map_html, height=450)
     
+    if loc.get('lat') is not None and loc.get('lon') is not None:
+        flagged = get_nearby_flagged_products(loc['lat'], loc['lon'])
+        if flagged:
+            st.markdown(f"**⚠️ Flagged Near You** <small style='color:#64748b;'>within {NEARBY_RADIUS_KM} km</small>", unsafe_allow_html=True)
+            for p in flagged:
+                color = '#ef4444' if p['high_caution'] * 2 >= p['count'] else '#f59e0b'
+                st.markdown(f"<div style='padding:0.3rem 0;border-bottom:1px solid #f1f5f9;'><span style='color:{color};font-weight:600;'>{p['avg_score']}/100</span> • {html.escape(p['product'][:30])} • <small style='color:#64748b;'>{p['count']}× flagged · {p['distance_km']} km</small></div>", unsafe_allow_html=True)
+    
     # Recent activity feed
-    if all_points:
+    recent = get_map_data(5) + [dict(d, product=d.get('product_name', '')) for d in get_global_scans(5)]
+    if recent:
         st.markdown("**📡 Recent Activity:**")
-        recent = all_points[:5]
-        for p in recent:
+        for p in recent[:5]:
             color = '#ef4444' if p.get('verdict') == 'HIGH_CAUTION' else '#f59e0b' if p.get('verdict') == 'CAUTION' else '#22c55e'
             st.markdown(f"<div style='padding:0.3rem 0;border-bottom:1px solid #f1f5f9;'><span style='color:{color};font-weight:600;'>{p.get('score', '?')}/100</span> • {p.get('product', 'Product')[:30]} • <small style='color:#64748b;'>{p.get('city', '')}</small></div>", unsafe_allow_html=True)
 
+@st.fragment
 def render_profile():
     st.markdown("### ⚙️ Settings")
     st.markdown("**📍 Location**")
@@ -2623,6 +4058,7 @@ def render_profile():
         save_allergies(new_allergies)
         st.success("✅ Saved!")
 
+@st.fragment
 def render_laws():
     st.markdown("### ⚖️ The 21 Integrity Laws")
     st.caption("With Logic Gates and Value Gap Detection")
@@ -2648,5 +4084,14 @@ def render_laws():
                         st.markdown(f"🔀 *Logic Gate: {law['logic_gate']}*")
                     st.markdown("---")
 
+# Tab label -> (renderer, takes user_id)
+TABS = {
+    "📷 Scan": (render_scan_tab, True),
+    "📋 History": (render_history, True),
+    "🗺️ World Map": (render_world_map, False),
+    "👤 Profile": (render_profile, False),
+    "⚖️ Laws": (render_laws, False),
+}
+
 if __name__ == "__main__":
     main()
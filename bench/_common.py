@@ -0,0 +1,32 @@
+"""Shared setup for the benchmark scripts: import app.py against a throwaway HOME.
+
+Each script takes --app DIR to benchmark another checkout, e.g. a baseline:
+    mkdir -p /tmp/old && git show <rev>:app.py > /tmp/old/app.py
+    python bench/decode_bench.py --app /tmp/old
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import warnings
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parser(description):
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('--app', default=REPO, help="directory containing the app.py to benchmark")
+    return p
+
+def load_app(app_dir=REPO):
+    """Import app.py from app_dir with its SQLite files in a fresh temporary HOME."""
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='hw-bench-')
+    logging.disable(logging.CRITICAL)
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, os.path.abspath(app_dir))
+    import app
+    return app
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
@@ -0,0 +1,78 @@
+"""Synthetic camera-like EAN-13 photos for the barcode decode benchmark.
+
+Each frame places one rendered EAN-13 on a blurred, text-cluttered background at
+640x480 to 4000x3000, then applies rotation (-40 to 180 degrees), perspective skew,
+reduced contrast, blur (sigma 0-3) and sensor noise, and encodes it as JPEG q85.
+The corpus is fully determined by (n, seed).
+"""
+import cv2
+import numpy as np
+
+L_CODES = ['0001101', '0011001', '0010011', '0111101', '0100011', '0110001', '0101111', '0111011', '0110111', '0001011']
+R_CODES = [''.join('1' if c == '0' else '0' for c in code) for code in L_CODES]
+G_CODES = [code[::-1] for code in R_CODES]
+PARITY = ['LLLLLL', 'LLGLGG', 'LLGGLG', 'LLGGGL', 'LGLLGG', 'LGGLLG', 'LGGGLL', 'LGLGLG', 'LGLGGL', 'LGGLGL']
+FRAME_SIZES = [(640, 480), (1280, 720), (1920, 1080), (4000, 3000)]
+ANGLES = [0, 0, 5, -12, 25, -40, 90, 180, 170]
+BLURS = [0, 0.6, 1.2, 2.0, 3.0]
+
+def check_digit(d12):
+    return str((10 - sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(d12)) % 10) % 10)
+
+def ean13_bits(code):
+    left = ''.join((L_CODES if p == 'L' else G_CODES)[int(c)] for p, c in zip(PARITY[int(code[0])], code[1:7]))
+    return '101' + left + '01010' + ''.join(R_CODES[int(c)] for c in code[7:]) + '101'
+
+def render(code, module=4, height=160, quiet=11):
+    bits = ean13_bits(code)
+    img = np.full((height + 40, (len(bits) + 2 * quiet) * module), 255, np.uint8)
+    for i, bit in enumerate(bits):
+        if bit == '1': img[20:20 + height, (quiet + i) * module:(quiet + i + 1) * module] = 0
+    cv2.putText(img, code, (quiet * module, height + 36), cv2.FONT_HERSHEY_SIMPLEX, module * 0.3, 0, max(1, module // 3))
+    return img
+
+def sample(rng, idx):
+    """One (code, jpeg bytes, meta) frame, or None when the barcode does not fit the frame."""
+    code = ''.join(str(d) for d in rng.integers(0, 10, 12))
+    code += check_digit(code)
+    W, H = FRAME_SIZES[idx % len(FRAME_SIZES)]
+    canvas = np.clip(rng.normal(rng.integers(60, 200), 25, (H, W)), 0, 255).astype(np.uint8)
+    canvas = cv2.GaussianBlur(canvas, (0, 0), 8)
+    for _ in range(8):
+        x, y = rng.integers(0, W), rng.integers(0, H)
+        cv2.putText(canvas, 'NUTRITION 123', (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, W / 1500, int(rng.integers(0, 80)), 2)
+    frac = rng.uniform(0.15, 0.45)
+    bc = render(code, module=max(1, int(W * frac / 113)))
+    angle = float(rng.choice(ANGLES))
+    h, w = bc.shape
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    cos, sin = abs(M[0, 0]), abs(M[0, 1])
+    nw, nh = int(h * sin + w * cos), int(h * cos + w * sin)
+    M[0, 2] += nw / 2 - w / 2
+    M[1, 2] += nh / 2 - h / 2
+    src = np.float32([[0, 0], [nw, 0], [nw, nh], [0, nh]])
+    k = rng.uniform(0, 0.12)
+    dst = np.float32([[nw * k, 0], [nw * (1 - k / 2), nh * k / 2], [nw, nh], [0, nh * (1 - k)]])
+    P = cv2.getPerspectiveTransform(src, dst)
+    rot = cv2.warpPerspective(cv2.warpAffine(bc, M, (nw, nh), borderValue=0), P, (nw, nh))
+    mask = cv2.warpPerspective(cv2.warpAffine(np.full_like(bc, 255), M, (nw, nh)), P, (nw, nh))
+    if nw >= W or nh >= H: return None
+    x, y = int(rng.integers(0, W - nw)), int(rng.integers(0, H - nh))
+    roi = canvas[y:y + nh, x:x + nw]
+    contrast = rng.uniform(0.45, 1.0)
+    lit = rot.astype(np.float32) * contrast + (1 - contrast) * 128
+    roi[mask > 0] = lit[mask > 0].astype(np.uint8)
+    sigma = float(rng.choice(BLURS))
+    if sigma: canvas = cv2.GaussianBlur(canvas, (0, 0), sigma * W / 1280)
+    canvas = np.clip(canvas + rng.normal(0, rng.uniform(2, 10), canvas.shape), 0, 255).astype(np.uint8)
+    ok, jpg = cv2.imencode('.jpg', cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR), [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return code, jpg.tobytes(), dict(size=(W, H), angle=angle, sigma=sigma, frac=round(frac, 2))
+
+def corpus(n=120, seed=7):
+    rng = np.random.default_rng(seed)
+    frames, i = [], 0
+    while len(frames) < n:
+        frame = sample(rng, i)
+        i += 1
+        if frame: frames.append(frame)
+    return frames
@@ -0,0 +1,53 @@
+"""fsyncs per completed contribute-flow scan.
+
+Builds bench/fsync_count.c with cc, re-runs itself under LD_PRELOAD and counts
+fsync/fdatasync calls while saving --n scans. Uses commit_scan when the app has it,
+otherwise the older save_scan + cache_barcode sequence. --synchronous overrides the
+synchronous pragma of the app's connection pool (when it has DB_PRAGMAS).
+
+    python bench/commit_bench.py [--n 200] [--synchronous FULL] [--app DIR]
+"""
+import ctypes
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app, parser
+
+SHIM_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fsync_count.c')
+
+def reexec_with_shim():
+    shim = os.path.join(tempfile.mkdtemp(prefix='hw-fsync-'), 'fsync_count.so')
+    subprocess.run(['cc', '-shared', '-fPIC', '-O2', '-o', shim, SHIM_SOURCE, '-ldl'], check=True)
+    env = dict(os.environ, LD_PRELOAD=shim, HW_FSYNC_SHIM=shim)
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--n', type=int, default=200)
+    p.add_argument('--synchronous', choices=['OFF', 'NORMAL', 'FULL'])
+    args = p.parse_args()
+    if not os.environ.get('HW_FSYNC_SHIM'): reexec_with_shim()
+    app = load_app(args.app)
+    if args.synchronous and hasattr(app, 'DB_PRAGMAS'):
+        app.DB_PRAGMAS = [(k, args.synchronous if k == 'synchronous' else v) for k, v in app.DB_PRAGMAS]
+    app.init_db()
+    uid = app.get_user_id()
+    count = ctypes.CDLL(None).hw_fsync_count
+    count.restype = ctypes.c_long
+    result = {'product_name': 'Bench Spread', 'brand': 'Acme', 'score': 55, 'verdict': 'CAUTION', 'violations': [], 'ingredients': ['water']}
+    location = {'lat': -27.5, 'lon': 153.0, 'city': 'Brisbane', 'country': 'Australia'}
+    before = count()
+    for i in range(args.n):
+        barcode, data = f'99{i:011d}', {'name': 'Bench Spread', 'brand': 'Acme', 'source': 'HonestWorld Community'}
+        if hasattr(app, 'commit_scan'):
+            app.commit_scan(result, uid, b'\xff\xd8thumb', location, barcode=barcode, barcode_data=data)
+        else:
+            app.save_scan(result, uid, b'\xff\xd8thumb', location)
+            app.cache_barcode(barcode, data)
+    print(f"fsyncs per scan: {(count() - before) / args.n:.2f}  ({args.n} scans, synchronous={args.synchronous or 'app default'})")
+
+if __name__ == '__main__':
+    main()
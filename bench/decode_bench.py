@@ -0,0 +1,66 @@
+"""Barcode decode accuracy and latency on the synthetic corpus (bench/barcode_corpus.py).
+
+Runs the full-frame pyzbar pass (try_decode_barcode_pyzbar) and the region engine
+(decode_barcode_image) over every frame, single process. "correct" counts reads equal to
+the rendered code (or its UPC-A form), "misread" counts any other non-empty read, and
+"read" is their sum. "peak" is the growth of peak RSS over one decode (p50 / max): the
+kernel high-water mark is reset through /proc/self/clear_refs before each frame, so it sees
+PIL and zbar buffers that tracemalloc cannot (Linux only, blank elsewhere).
+
+    python bench/decode_bench.py [--n 120] [--seed 7] [--app DIR]
+"""
+import io
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app, parser, percentile
+import barcode_corpus
+
+def _status_kb(field):
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field))
+
+def peak_growth(decode, buf):
+    """Run decode(buf) and return (result, peak RSS growth in MB), or None growth off Linux."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+        before = _status_kb('VmRSS:')
+    except OSError:
+        return decode(buf), None
+    result = decode(buf)
+    return result, (_status_kb('VmHWM:') - before) / 1024
+
+def peak_column(peaks):
+    return f"{percentile(peaks, .5):.0f}/{max(peaks):.0f}MB" if peaks else ''
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--n', type=int, default=120)
+    p.add_argument('--seed', type=int, default=7)
+    args = p.parse_args()
+    app = load_app(args.app)
+    frames = barcode_corpus.corpus(args.n, args.seed)
+    decoders = [('full-frame pass', 'try_decode_barcode_pyzbar'), ('region engine', 'decode_barcode_image')]
+    print(f"{'decoder':16s} {'correct':>8s} {'misread':>8s} {'read':>5s} {'p50':>8s} {'p95':>8s} {'mean':>8s} {'peak p50/max':>14s}")
+    for label, name in decoders:
+        decode = getattr(app, name, None)
+        if decode is None:
+            print(f"{label:16s} (not in this app.py)")
+            continue
+        latencies, peaks, correct, misread, missed = [], [], 0, 0, Counter()
+        for code, jpg, meta in frames:
+            start = time.perf_counter()
+            read, peak = peak_growth(decode, io.BytesIO(jpg))
+            latencies.append((time.perf_counter() - start) * 1000)
+            if peak is not None: peaks.append(peak)
+            if read in (code, code[1:]): correct += 1
+            elif read: misread += 1
+            else: missed[meta['size']] += 1
+        print(f"{label:16s} {correct:8d} {misread:8d} {correct + misread:5d} {percentile(latencies, .5):6.0f}ms {percentile(latencies, .95):6.0f}ms {sum(latencies) / len(latencies):6.0f}ms {peak_column(peaks):>14s}")
+        print(f"{'':16s} missed by frame size: {dict(missed)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+/* LD_PRELOAD shim counting fsync/fdatasync calls; built and loaded by commit_bench.py. */
+#define _GNU_SOURCE
+#include <dlfcn.h>
+
+static long calls = 0;
+
+int fsync(int fd) {
+    static int (*real)(int) = 0;
+    if (!real) real = dlsym(RTLD_NEXT, "fsync");
+    calls++;
+    return real(fd);
+}
+
+int fdatasync(int fd) {
+    static int (*real)(int) = 0;
+    if (!real) real = dlsym(RTLD_NEXT, "fdatasync");
+    calls++;
+    return real(fd);
+}
+
+long hw_fsync_count(void) { return calls; }
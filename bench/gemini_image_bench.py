@@ -0,0 +1,68 @@
+"""Gemini request size and image prep time, raw PIL image versus prepare_gemini_image.
+
+Serializes the real GenerateContentRequest (analysis prompt plus one photo) for six
+synthetic label photos from 4032x3024 to 1280x960, some EXIF-rotated. "before" passes
+the opened PIL image as analyze_product used to, which the SDK sends as a lossless
+WebP of the full frame; "after" passes prepare_gemini_image's blob. No network calls.
+
+    python bench/gemini_image_bench.py [--app DIR]
+"""
+import io
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app, parser
+
+def label_photo(rng, w, h, orientation=1):
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    base = np.zeros((h, w, 3), np.float32)
+    for c in range(3): base[..., c] = 90 + 60 * np.sin(xx / (300 + 80 * c)) + 40 * np.cos(yy / (250 + 60 * c))
+    img = np.clip(base + rng.normal(0, 6, base.shape), 0, 255).astype(np.uint8)
+    x0, y0 = w // 4, h // 5
+    cv2.rectangle(img, (x0, y0), (3 * w // 4, 4 * h // 5), (245, 240, 230), -1)
+    for i in range(28):
+        cv2.putText(img, f'Ingredients: sugar, palm oil, hazelnuts 13%, skim milk powder {i}', (x0 + 40, y0 + 80 + i * h // 50),
+                    cv2.FONT_HERSHEY_SIMPLEX, w / 3000, (30, 30, 30), max(1, w // 1500))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buf = io.BytesIO()
+    Image.fromarray(cv2.GaussianBlur(img, (0, 0), 0.8)[..., ::-1]).save(buf, 'JPEG', quality=92, exif=exif.tobytes())
+    return buf.getvalue()
+
+def main():
+    args = parser(__doc__.splitlines()[0]).parse_args()
+    app = load_app(args.app)
+    from google.generativeai import protos
+    from google.generativeai.types import content_types
+    prompt = app.ANALYSIS_PROMPT.format(location='Brisbane, Australia', barcode_context='')
+    def request_bytes(parts):
+        request = protos.GenerateContentRequest(model='models/bench', contents=content_types.to_contents([prompt] + parts))
+        return request._pb.ByteSize()
+    rng = np.random.default_rng(3)
+    photos = [label_photo(rng, 4032, 3024, o) for o in (1, 6, 1)] + [label_photo(rng, 3000, 4000), label_photo(rng, 1920, 1080), label_photo(rng, 1280, 960, 8)]
+    print(f"prompt alone: {request_bytes([]) / 1e3:.1f} KB")
+    before, after, prep_before, prep_after = [], [], [], []
+    for jpg in photos:
+        start = time.perf_counter()
+        before.append(request_bytes([Image.open(io.BytesIO(jpg))]))
+        prep_before.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        blob = app.prepare_gemini_image(io.BytesIO(jpg))
+        after.append(request_bytes([blob]))
+        prep_after.append(time.perf_counter() - start)
+        print(f"{str(Image.open(io.BytesIO(jpg)).size):13s} {len(jpg) / 1e6:.2f} MB | before {before[-1] / 1e6:5.2f} MB in {prep_before[-1] * 1000:6.0f} ms"
+              f" | after {after[-1] / 1e3:4.0f} KB in {prep_after[-1] * 1000:4.0f} ms, sent {Image.open(io.BytesIO(blob['data'])).size}")
+    print(f"total request bytes: before {sum(before) / 1e6:.1f} MB, after {sum(after) / 1e6:.2f} MB ({sum(before) / sum(after):.0f}x less);"
+          f" median prep before {np.median(prep_before) * 1000:.0f} ms, after {np.median(prep_after) * 1000:.0f} ms")
+    for mbps in (20, 100):
+        print(f"one 12 MP request at {mbps} Mbit/s (prep + upload): before {before[0] * 8 / mbps / 1e6 + prep_before[0]:.2f} s,"
+              f" after {after[0] * 8 / mbps / 1e6 + prep_after[0]:.2f} s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Batch geohash encode/decode throughput, checked against the original scalar loop.
+
+    python bench/geohash_bench.py [--n 1000000] [--precision 6] [--app DIR]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app, parser
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def scalar_geohash(lat, lon, precision=6):
+    """The per-point bisection loop encode_geohash used before the NumPy encoder."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, bit, ch, even = [], [16, 8, 4, 2, 1], 0, 0, True
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon > mid: ch |= bits[bit]; lon_range[0] = mid
+            else: lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat > mid: ch |= bits[bit]; lat_range[0] = mid
+            else: lat_range[1] = mid
+        even = not even
+        if bit < 4: bit += 1
+        else: geohash.append(BASE32[ch]); bit, ch = 0, 0
+    return ''.join(geohash)
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--n', type=int, default=1_000_000)
+    p.add_argument('--precision', type=int, default=6)
+    args = p.parse_args()
+    app = load_app(args.app)
+    rng = np.random.default_rng(0)
+
+    # Agreement with the scalar loop, including points exactly on cell edges
+    lats = np.concatenate([rng.uniform(-90, 90, 200_000), [0, 45, -45, 90, -90, 22.5, 0]])
+    lons = np.concatenate([rng.uniform(-180, 180, 200_000), [0, 90, -90, 180, -180, -180, 11.25]])
+    for precision in (1, 5, 6, 9, 12):
+        batch = app.encode_geohash_array(lats, lons, precision)
+        mismatches = sum(scalar_geohash(lats[i], lons[i], precision) != batch[i] for i in range(0, len(lats), 7))
+        print(f"precision {precision:2d}: {mismatches} mismatches against the scalar loop")
+
+    lats, lons = rng.uniform(-90, 90, args.n), rng.uniform(-180, 180, args.n)
+    start = time.perf_counter()
+    hashes = app.encode_geohash_array(lats, lons, args.precision)
+    encode = time.perf_counter() - start
+    start = time.perf_counter()
+    app.decode_geohash_array(hashes)
+    decode = time.perf_counter() - start
+    sample = min(args.n, 100_000)
+    start = time.perf_counter()
+    for i in range(sample): scalar_geohash(lats[i], lons[i], args.precision)
+    scalar = (time.perf_counter() - start) * args.n / sample
+    print(f"{args.n:,} points, precision {args.precision}: batch encode {encode:.2f} s ({args.n / encode / 1e6:.1f} M/s), "
+          f"batch decode {decode:.2f} s, scalar loop {scalar:.1f} s (extrapolated from {sample:,})")
+    start = time.perf_counter()
+    for _ in range(10_000): app.encode_geohash(-27.5, 153.0)
+    print(f"encode_geohash single point: {(time.perf_counter() - start) / 10_000 * 1e6:.0f} us/call")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Full-rerun script time and SQL statements per rerun, per tab, with Streamlit's AppTest.
+
+Seeds a throwaway DB with 300 local scans and 20k replica rows, then reruns each tab
+--runs times. "script" is the time Streamlit spends executing app.py (timed around its
+script runner's exec call); "round trip" adds AppTest's own overhead. SQL statements are
+counted by a trace callback on every sqlite3 connection the app opens; a rerun served
+entirely from caches shows 0.
+
+    python bench/rerun_bench.py [--runs 8] [--app DIR]
+"""
+import os
+import sqlite3
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app, parser
+
+statements = [0]
+script_ms = []
+
+def time_script_runs():
+    from streamlit.runtime.scriptrunner import script_runner
+    real_exec = script_runner.exec_func_with_error_handling
+    def timed(func, ctx):
+        start = time.perf_counter()
+        try: return real_exec(func, ctx)
+        finally: script_ms.append((time.perf_counter() - start) * 1000)
+    script_runner.exec_func_with_error_handling = timed
+
+def count_statements():
+    real_connect = sqlite3.connect
+    def connect(*args, **kwargs):
+        conn = real_connect(*args, **kwargs)
+        conn.set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1))
+        return conn
+    sqlite3.connect = connect
+
+def seed(app):
+    app.init_db()
+    uid = app.get_user_id()
+    result = {'product_name': 'Bench Spread', 'brand': 'Acme', 'score': 55, 'verdict': 'CAUTION', 'violations': [], 'ingredients': ['water']}
+    location = {'lat': -27.5, 'lon': 153.0, 'city': 'Brisbane', 'country': 'Australia'}
+    save = getattr(app, 'commit_scan', None) or app.save_scan
+    for i in range(300): save(dict(result, score=20 + i % 70), uid, b'\xff\xd8thumb' + bytes([i % 256]), location)
+    if hasattr(app, 'encode_geohash_array'):
+        rng = np.random.default_rng(0)
+        lats, lons = rng.uniform(-60, 70, 20_000), rng.uniform(-180, 180, 20_000)
+        hashes = app.encode_geohash_array(lats, lons)
+        with app.db_transaction() as c:
+            c.executemany('INSERT INTO global_scans (id, lat, lon, geohash, score, verdict, city, product_name, created_at) VALUES (?,?,?,?,?,?,?,?,?)',
+                          [(i + 1, float(lats[i]), float(lons[i]), str(hashes[i]), 50, 'CAUTION', 'C', 'P', '2026') for i in range(len(lats))])
+    app.save_location('Brisbane', 'Australia', -27.5, 153.0)
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--runs', type=int, default=8)
+    args = p.parse_args()
+    count_statements()
+    time_script_runs()
+    app = load_app(args.app)
+    seed(app)
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(os.path.join(os.path.abspath(args.app), 'app.py'), default_timeout=120)
+    at.run()
+    tabs = [None]
+    try: tabs = at.radio(key='nav_tab').options
+    except Exception: print("no nav_tab radio: timing the whole page (all tabs render on every rerun)")
+    for tab in tabs:
+        if tab is not None: at.radio(key='nav_tab').set_value(tab).run()
+        times, scripts, queries = [], [], []
+        for _ in range(args.runs):
+            before, start = statements[0], time.perf_counter()
+            del script_ms[:]
+            at.run()
+            times.append((time.perf_counter() - start) * 1000)
+            scripts.append(sum(script_ms))
+            queries.append(statements[0] - before)
+        assert not at.exception, [e.value for e in at.exception]
+        print(f"{tab or 'page':14s} script median {statistics.median(scripts):6.1f} ms  round trip median {statistics.median(times):6.1f} ms  SQL statements/rerun {statistics.median(queries):.0f}")
+
+if __name__ == '__main__':
+    main()
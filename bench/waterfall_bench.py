@@ -0,0 +1,81 @@
+"""Barcode provider lookup latency, sequential versus the concurrent waterfall.
+
+Open Food Facts, Open Beauty Facts and UPC Item DB are served by a local HTTP stub
+with log-normal latency (medians 350/300/450 ms). Each run looks up fresh barcodes,
+split evenly between food hits, cosmetic hits and unknown products. "sequential"
+awaits each provider in priority order; "concurrent" is waterfall_barcode_search.
+
+    python bench/waterfall_bench.py [--n 90] [--app DIR]
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app, parser, percentile
+
+LATENCY = {'openfoodfacts': 0.35, 'openbeautyfacts': 0.30, 'upcitemdb': 0.45}
+KINDS = {'1': 'food', '2': 'cosmetic', '0': 'unknown'}
+
+class StubProvider(BaseHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+    def do_GET(self):
+        host = self.headers.get('X-Orig-Host', '')
+        name = next((k for k in LATENCY if k in host), None)
+        if name: time.sleep(random.lognormvariate(0, 0.35) * LATENCY[name])
+        kind = re.search(r'(\d{13})', self.path).group(1)[-1]
+        if name == 'openfoodfacts': body = {'status': 1, 'product': {'product_name': 'Food'}} if kind == '1' else {'status': 0}
+        elif name == 'openbeautyfacts': body = {'status': 1, 'product': {'product_name': 'Cream'}} if kind == '2' else {'status': 0}
+        else: body = {'items': []}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def route_to_stub(app, port):
+    """Send the app's outbound requests to the stub, keeping the original host in a header."""
+    real = app.http_request
+    def local(method, url, **kwargs):
+        m = re.match(r'https?://([^/]+)(/.*)', url)
+        headers = dict(kwargs.pop('headers', None) or {}, **{'X-Orig-Host': m.group(1)})
+        return real(method, f'http://127.0.0.1:{port}{m.group(2)}', headers=headers, **kwargs)
+    app.http_request = local
+
+def sequential(app, barcode):
+    for name, lookup, *_ in app.barcode_providers(barcode):
+        result = lookup(barcode)
+        if result: return result
+    return None
+
+def main():
+    p = parser(__doc__.splitlines()[0])
+    p.add_argument('--n', type=int, default=90)
+    args = p.parse_args()
+    random.seed(1)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubProvider)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app = load_app(args.app)
+    app.init_db()
+    route_to_stub(app, server.server_address[1])
+    runs = [('sequential', lambda bc: sequential(app, bc), 700000000000), ('concurrent', app.waterfall_barcode_search, 800000000000)]
+    for label, search, base in runs:
+        latencies = {kind: [] for kind in KINDS}
+        for i in range(args.n):
+            kind = '120'[i % 3]
+            start = time.perf_counter()
+            search(f'{base + i:012d}{kind}')
+            latencies[kind].append((time.perf_counter() - start) * 1000)
+        everything = sum(latencies.values(), [])
+        cells = [f"{KINDS[k]} p50 {percentile(v, .5):4.0f} p95 {percentile(v, .95):4.0f}" for k, v in latencies.items()]
+        print(f"{label:11s} " + " | ".join(cells) + f" | all p50 {percentile(everything, .5):4.0f} p95 {percentile(everything, .95):4.0f} ms")
+
+if __name__ == '__main__':
+    main()